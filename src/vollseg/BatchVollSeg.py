@@ -0,0 +1,138 @@
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from tifffile import imread
+from tqdm import tqdm
+
+from .framewriter import _params_hash
+from .utils import VollSeg
+
+
+class BatchVollSeg:
+    """
+    Segments every image of a directory with VollSeg (or VollOne) and writes
+    the outputs to save_dir/<Output>/<file stem>.
+
+    The models are passed in once and shared by all files, and the next file
+    is read and hashed while the current one is segmented. save_dir keeps a
+    manifest of the finished files, keyed by the hash of the file content
+    plus the hash of the parameters, with the outputs each one produced.
+    Files whose entry matches and whose outputs are still on disk are
+    skipped, so a rerun after a failure only segments what is missing.
+    """
+
+    def __init__(
+        self,
+        image_dir,
+        save_dir,
+        segment=VollSeg,
+        pattern="*.tif",
+        **params,
+    ):
+        """
+        :param segment: VollSeg or VollOne, VollSeg covers VollSeg_unet when
+            no star_model is given
+        :param pattern: Glob pattern of the images in image_dir
+        :param params: Models and keyword arguments passed to segment
+        """
+        self.image_dir = Path(image_dir)
+        self.save_dir = Path(save_dir)
+        self.segment = segment
+        self.pattern = pattern
+        self.params = params
+        self.params_hash = _params_hash(segment, params)
+        self.manifest_file = self.save_dir / "manifest.json"
+        self.save_dir.mkdir(parents=True, exist_ok=True)
+        self.manifest = {}
+        if self.manifest_file.exists():
+            self.manifest = json.loads(self.manifest_file.read_text())
+
+    def files(self):
+
+        return sorted(self.image_dir.glob(self.pattern))
+
+    def is_done(self, key, fname):
+
+        entry = self.manifest.get(key)
+        if entry is None or entry["file"] != fname.name:
+            return False
+        return all(
+            _output_size(self.save_dir / output) == size
+            for output, size in entry["outputs"].items()
+        )
+
+    def load(self, fname):
+        """
+        :return: The manifest key of the file and the image, None when its
+            outputs are up to date
+        """
+        key = _file_hash(fname) + "_" + self.params_hash
+        if self.is_done(key, fname):
+            return key, None
+        return key, imread(fname)
+
+    def outputs(self, name):
+
+        return {
+            path.relative_to(self.save_dir).as_posix(): _output_size(path)
+            for path in self.save_dir.glob(f"*/{name}.*")
+        }
+
+    def save_manifest(self):
+
+        tmp_file = self.manifest_file.with_name(self.manifest_file.name + ".tmp")
+        tmp_file.write_text(json.dumps(self.manifest, indent=1))
+        os.replace(tmp_file, self.manifest_file)
+
+    def run(self):
+        """
+        :return: The files segmented in this run
+        """
+        files = self.files()
+        segmented = []
+        if not files:
+            return segmented
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            future = executor.submit(self.load, files[0])
+            for i, fname in enumerate(tqdm(files)):
+                key, image = future.result()
+                if i + 1 < len(files):
+                    future = executor.submit(self.load, files[i + 1])
+                if image is None:
+                    continue
+                self.segment(
+                    image,
+                    save_dir=self.save_dir.as_posix(),
+                    Name=fname.stem,
+                    **self.params,
+                )
+                del image
+                self.manifest[key] = {
+                    "file": fname.name,
+                    "outputs": self.outputs(fname.stem),
+                }
+                self.save_manifest()
+                segmented.append(fname)
+        return segmented
+
+
+def _file_hash(fname, chunk_size=1 << 24):
+
+    digest = hashlib.sha1()
+    with open(fname, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _output_size(path):
+
+    if path.is_dir():
+        # zarr stores
+        return sum(p.stat().st_size for p in path.rglob("*") if p.is_file())
+    if path.exists():
+        return path.stat().st_size
+    return None
@@ -4,6 +4,9 @@ from .pretrained import (
     get_registered_models,
     get_model_details,
     get_model_instance,
+    register_model,
+    register_aliases,
+    clear_models_and_aliases,
 )
 import sys
 
@@ -118,3 +121,21 @@ class CARE(CARE):
         self._training_finished()
 
         return history
+
+
+clear_models_and_aliases(CARE)
+
+register_model(
+    CARE,
+    "Denoise_3D_cells",
+    "https://zenodo.org/record/6671170/files/GenericDenoising3D.zip",
+    "a0eb25ffd794e2b3b31a4de5b72a392f",
+)
+register_model(
+    CARE,
+    "Denoise_carcinoma",
+    "https://zenodo.org/record/5910645/files/denoise_carcinoma.zip",
+    "fd33199738f0b17761272118cbffdf04",
+)
+
+register_aliases(CARE, "Denoise_3D_cells", "Denoise_3D_cells")
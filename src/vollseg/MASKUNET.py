@@ -1,5 +1,12 @@
 from csbdeep.models import CARE
-from .pretrained import get_registered_models, get_model_details, get_model_instance
+from .pretrained import (
+    get_registered_models,
+    get_model_details,
+    get_model_instance,
+    register_model,
+    register_aliases,
+    clear_models_and_aliases,
+)
 import sys
 
 # if IS_TF_1:
@@ -66,3 +73,26 @@ class MASKUNET(CARE):
                 )
                 sys.stderr.flush()
             get_registered_models(cls, verbose=True)
+
+
+clear_models_and_aliases(MASKUNET)
+
+register_model(
+    MASKUNET,
+    "Xenopus_Cell_Tissue_Segmentation",
+    "https://zenodo.org/record/6060378/files/Xenopus_tissue_model.zip",
+    "2694d8b05fa828aceb055eef8cd5ca1f",
+)
+register_model(
+    MASKUNET,
+    "Unet_Arabidopsis_Mask",
+    "https://zenodo.org/record/6670732/files/Unet_Arabidopsis_Mask.zip",
+    "114df78e0153b39d80d0253a4dcc236f",
+)
+
+register_aliases(
+    MASKUNET,
+    "Xenopus_Cell_Tissue_Segmentation",
+    "Xenopus_Cell_Tissue_Segmentation",
+)
+register_aliases(MASKUNET, "Unet_Arabidopsis_Mask", "Unet_Arabidopsis_Mask")
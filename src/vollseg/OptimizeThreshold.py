@@ -8,10 +8,12 @@ import numpy as np
 from tqdm import tqdm
 from csbdeep.utils import save_json
 from csbdeep.utils import normalize
-from stardist.matching import matching_dataset
 from scipy.optimize import minimize_scalar
 from csbdeep.utils import _raise
+from concurrent.futures import ThreadPoolExecutor
 from .utils import VollSeg
+from .matching import matching, accumulate_matching
+from .cachedmodel import CachedModel
 
 
 class OptimizeThreshold:
@@ -33,11 +35,15 @@ class OptimizeThreshold:
         measure="accuracy",
         RGB=False,
         axes="ZYX",
+        search="golden",
+        prob_threshs=np.linspace(0.1, 0.9, 17),
+        n_workers=2,
     ):
 
-        self.star_model = star_model
-        self.unet_model = unet_model
-        self.noise_model = noise_model
+        # networks run once per image, threshold probes redo post-processing
+        self.star_model = None if star_model is None else CachedModel(star_model)
+        self.unet_model = None if unet_model is None else CachedModel(unet_model)
+        self.noise_model = None if noise_model is None else CachedModel(noise_model)
         self.n_tiles = n_tiles
         self.basedir = basedir
         self.UseProbability = UseProbability
@@ -48,10 +54,14 @@ class OptimizeThreshold:
         self.seedpool = seedpool
         self.axes = axes
         self.nms_threshs = nms_threshs
-        self.iou_threshs = iou_threshs
+        self.iou_threshs = [iou_threshs] if np.isscalar(iou_threshs) else iou_threshs
         self.measure = measure
 
         self.min_size = min_size
+        self.search = search
+        self.prob_threshs = prob_threshs
+        self.n_workers = n_workers
+        self.stats = dict()
 
         self.Optimize()
 
@@ -62,36 +72,45 @@ class OptimizeThreshold:
 
         print("Images to apply prediction on", len(self.X))
 
-        (
-            opt_prob_thresh_voll,
-            opt_measure_voll,
-            opt_nms_thresh,
-            opt_prob_thresh_star,
-            _,
-        ) = (None, -np.inf, None, None, -np.inf)
-        for _opt_nms_thresh in self.nms_threshs:
+        if self.search == "grid":
+            opt_threshs_voll, opt_threshs_star, _, _ = self.optimize_grid(
+                [float(t) for t in self.prob_threshs],
+                [float(t) for t in self.nms_threshs],
+                measure=self.measure,
+            )
+        else:
             (
-                _opt_prob_thresh_voll,
-                _opt_measure_voll,
-                _opt_prob_thresh_star,
-                _opt_measure_star,
-            ) = self.optimize_threshold(self.Y, nms_thresh=_opt_nms_thresh)
-            if _opt_measure_voll > opt_measure_voll:
+                opt_prob_thresh_voll,
+                opt_measure_voll,
+                opt_nms_thresh,
+                opt_prob_thresh_star,
+                _,
+            ) = (None, -np.inf, None, None, -np.inf)
+            for _opt_nms_thresh in self.nms_threshs:
                 (
-                    opt_prob_thresh_voll,
-                    opt_measure_voll,
-                    opt_nms_thresh,
-                    opt_prob_thresh_star,
-                    _,
-                ) = (
                     _opt_prob_thresh_voll,
                     _opt_measure_voll,
-                    _opt_nms_thresh,
                     _opt_prob_thresh_star,
                     _opt_measure_star,
+                ) = self.optimize_threshold(
+                    self.Y, nms_thresh=_opt_nms_thresh, measure=self.measure
                 )
-        opt_threshs_voll = dict(prob=opt_prob_thresh_voll, nms=opt_nms_thresh)
-        opt_threshs_star = dict(prob=opt_prob_thresh_star, nms=opt_nms_thresh)
+                if _opt_measure_voll > opt_measure_voll:
+                    (
+                        opt_prob_thresh_voll,
+                        opt_measure_voll,
+                        opt_nms_thresh,
+                        opt_prob_thresh_star,
+                        _,
+                    ) = (
+                        _opt_prob_thresh_voll,
+                        _opt_measure_voll,
+                        _opt_nms_thresh,
+                        _opt_prob_thresh_star,
+                        _opt_measure_star,
+                    )
+            opt_threshs_voll = dict(prob=opt_prob_thresh_voll, nms=opt_nms_thresh)
+            opt_threshs_star = dict(prob=opt_prob_thresh_star, nms=opt_nms_thresh)
 
         self.thresholds_voll = opt_threshs_voll
         self.thresholds_star = opt_threshs_star
@@ -124,102 +143,127 @@ class OptimizeThreshold:
         self.iou_threshs = (
             [self.iou_threshs] if np.isscalar(self.iou_threshs) else self.iou_threshs
         )
-        values_voll = dict()
-        values_star = dict()
         with tqdm(
-            total=maxiter,
+            total=2 * maxiter,
             disable=(verbose != 1),
             desc="NMS threshold = %g" % nms_thresh,
         ) as progress:
 
-            def fn(thr):
-                prob_thresh = thr
-                value_voll = values_voll.get(prob_thresh)
-                value_star = values_star.get(prob_thresh)
-                if value_voll is None:
-                    res = tuple(
-                        zip(
-                            *tuple(
-                                VollSeg(
-                                    x,
-                                    unet_model=self.unet_model,
-                                    star_model=self.star_model,
-                                    axes=self.axes,
-                                    noise_model=self.noise_model,
-                                    n_tiles=self.n_tiles,
-                                    UseProbability=self.UseProbability,
-                                    dounet=self.dounet,
-                                    seedpool=self.seedpool,
-                                    RGB=self.RGB,
-                                )
-                                for x in tqdm(self.X)
-                            )
-                        )
-                    )
+            def evaluate(thr):
+                prob_thresh = float(thr)
+                value_voll, value_star = self.score(prob_thresh, nms_thresh, measure)
 
-                    if self.noise_model is None and self.star_model is not None:
-                        (
-                            Sizedsmart_seeds,
-                            SizedMask,
-                            star_labels,
-                            proabability_map,
-                            Markers,
-                            Skeleton,
-                        ) = res
-
-                    elif self.noise_model is not None and self.star_model is not None:
-                        (
-                            Sizedsmart_seeds,
-                            SizedMask,
-                            star_labels,
-                            proabability_map,
-                            Markers,
-                            Skeleton,
-                            image,
-                        ) = res
-
-                    elif self.star_model is None:
-
-                        raise ValueError(
-                            f"StarDist model can not be {self.star_model} for evaluating optimized threshold"
-                        )
-
-                    stats_voll = matching_dataset(
-                        Y,
-                        Sizedsmart_seeds,
-                        thresh=self.iou_threshs,
-                        show_progress=False,
-                        parallel=True,
-                    )
-                    values_voll[prob_thresh] = value_voll = np.mean(
-                        [s._asdict()[measure] for s in stats_voll]
-                    )
+                progress.update()
+                progress.set_postfix_str(
+                    f"VollSeg-StarDist, {prob_thresh:.3f} -> {value_voll:.3f}, {value_star:.3f}"
+                )
 
-                    stats_star = matching_dataset(
-                        Y,
-                        star_labels,
-                        thresh=self.iou_threshs,
-                        show_progress=False,
-                        parallel=True,
-                    )
-                    values_star[prob_thresh] = value_star = np.mean(
-                        [s._asdict()[measure] for s in stats_star]
-                    )
+                progress.refresh()
 
-                    progress.update()
-                    progress.set_postfix_str(
-                        f"VollSeg-StarDist, {prob_thresh:.3f} -> {value_voll:.3f}, {value_star:.3f}"
-                    )
+                return value_voll, value_star
 
-                    progress.refresh()
+            # probes of both searches share the memoized evaluations
+            opt_voll = minimize_scalar(
+                lambda thr: -evaluate(thr)[0],
+                method="bounded",
+                bounds=(0, 1),
+                options={"maxiter": maxiter, "xatol": tol},
+            )
+            opt_star = minimize_scalar(
+                lambda thr: -evaluate(thr)[1],
+                method="bounded",
+                bounds=(0, 1),
+                options={"maxiter": maxiter, "xatol": tol},
+            )
 
-                return -value_voll, -value_star
+        return opt_voll.x, -opt_voll.fun, opt_star.x, -opt_star.fun
 
-            opt_voll, opt_star = minimize_scalar(
-                fn, method="golden", tol=tol, options={"maxiter": maxiter}
+    def image_stats(self, i, prob_thresh, nms_thresh):
+        """Matching stats of the VollSeg seeds and StarDist labels of image i,
+        memoized per (image, thresholds)."""
+        key = (i, prob_thresh, nms_thresh)
+        if key not in self.stats:
+            if self.star_model is None:
+                raise ValueError(
+                    f"StarDist model can not be {self.star_model} for evaluating optimized threshold"
+                )
+            res = VollSeg(
+                self.X[i],
+                unet_model=self.unet_model,
+                star_model=self.star_model,
+                axes=self.axes,
+                noise_model=self.noise_model,
+                prob_thresh=prob_thresh,
+                nms_thresh=nms_thresh,
+                n_tiles=self.n_tiles,
+                UseProbability=self.UseProbability,
+                dounet=self.dounet,
+                seedpool=self.seedpool,
+                RGB=self.RGB,
             )
+            Sizedsmart_seeds, star_labels = res[0], res[2]
+            self.stats[key] = tuple(
+                matching(self.Y[i], y_pred, thresh=self.iou_threshs)
+                for y_pred in (Sizedsmart_seeds, star_labels)
+            )
+        return self.stats[key]
 
-        return opt_voll.x, -opt_voll.fun, opt_star.x, -opt_star.fun
+    def score(self, prob_thresh, nms_thresh, measure="accuracy"):
+        """Dataset scores of VollSeg and StarDist for one pair of thresholds,
+        averaged over iou_threshs."""
+        stats = [
+            self.image_stats(i, prob_thresh, nms_thresh) for i in range(len(self.X))
+        ]
+        return tuple(
+            np.mean(
+                [
+                    s._asdict()[measure]
+                    for s in accumulate_matching(
+                        [image_stats[k] for image_stats in stats], self.iou_threshs
+                    )
+                ]
+            )
+            for k in range(2)
+        )
+
+    def optimize_grid(self, prob_threshs, nms_threshs, measure="accuracy"):
+        """Evaluate every (nms_thresh, prob_thresh, image) on a thread pool and
+        return the optimal thresholds with the full score surfaces."""
+        if len(self.X) > 0 and len(self.stats) == 0:
+            # run the networks once, before fanning out post-processing
+            for i in tqdm(range(len(self.X)), desc="Caching network outputs"):
+                self.image_stats(i, prob_threshs[0], nms_threshs[0])
+
+        jobs = [
+            (i, prob_thresh, nms_thresh)
+            for nms_thresh in nms_threshs
+            for prob_thresh in prob_threshs
+            for i in range(len(self.X))
+        ]
+        with ThreadPoolExecutor(max_workers=self.n_workers) as executor:
+            list(
+                tqdm(
+                    executor.map(lambda job: self.image_stats(*job), jobs),
+                    total=len(jobs),
+                    desc="Threshold grid",
+                )
+            )
+
+        surface_voll = np.zeros((len(nms_threshs), len(prob_threshs)))
+        surface_star = np.zeros((len(nms_threshs), len(prob_threshs)))
+        for n, nms_thresh in enumerate(nms_threshs):
+            for p, prob_thresh in enumerate(prob_threshs):
+                surface_voll[n, p], surface_star[n, p] = self.score(
+                    prob_thresh, nms_thresh, measure
+                )
+        self.score_surface_voll = surface_voll
+        self.score_surface_star = surface_star
+
+        n_voll, p_voll = np.unravel_index(np.argmax(surface_voll), surface_voll.shape)
+        n_star, p_star = np.unravel_index(np.argmax(surface_star), surface_star.shape)
+        opt_threshs_voll = dict(prob=prob_threshs[p_voll], nms=nms_threshs[n_voll])
+        opt_threshs_star = dict(prob=prob_threshs[p_star], nms=nms_threshs[n_star])
+        return opt_threshs_voll, opt_threshs_star, surface_voll, surface_star
 
 
 def _is_floatarray(x):
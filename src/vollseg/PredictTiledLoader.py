@@ -1,5 +1,6 @@
 import numpy as np
-from torch.utils.data import Dataset
+import torch
+from torch.utils.data import DataLoader, Dataset
 from .Tiles_3D import VolumeSlicer
 
 
@@ -31,10 +32,45 @@ class PredictTiled(Dataset):
 
     def __getitem__(self, idx):
 
-        self.tiler.split(idx)
+        # get_patch leaves the tiler untouched, so workers can share it
+        tile, patch_start, patch_end = self.tiler.get_patch(idx)
 
         return (
-            self.tiler.tile[np.newaxis, ...],
-            self.tiler.patch_start,
-            self.tiler.patch_end,
+            np.ascontiguousarray(tile[np.newaxis, ...]),
+            patch_start,
+            patch_end,
+        )
+
+    @staticmethod
+    def collate(batch):
+        """
+        Stacks (tile, patch_start, patch_end) samples into [B,1,Z,Y,X], [B,3]
+        and [B,3] tensors
+        """
+        tiles, patch_starts, patch_ends = zip(*batch)
+
+        return (
+            torch.from_numpy(np.stack(tiles)),
+            torch.from_numpy(np.stack(patch_starts)),
+            torch.from_numpy(np.stack(patch_ends)),
+        )
+
+    def loader(self, batch_size=1, num_workers=0, pin_memory=True, prefetch_factor=2):
+        """
+        DataLoader over the tiles in order: workers cut the next batches while
+        the model runs on the current one, and batches land in pinned memory
+        for asynchronous copies to the GPU
+        """
+        kwargs = {}
+        if num_workers > 0:
+            kwargs = dict(prefetch_factor=prefetch_factor, persistent_workers=True)
+
+        return DataLoader(
+            self,
+            batch_size=batch_size,
+            shuffle=False,
+            num_workers=num_workers,
+            collate_fn=self.collate,
+            pin_memory=pin_memory and torch.cuda.is_available(),
+            **kwargs,
         )
@@ -1,5 +1,7 @@
 import numpy as np
 import os
+import hashlib
+import json
 
 # from IPython.display import clear_output
 from stardist.models import Config3D, StarDist3D
@@ -11,36 +13,24 @@ from csbdeep.models import Config
 from .CARE import CARE
 from tensorflow.keras.utils import Sequence
 from csbdeep.data import RawData, create_patches
-from skimage.measure import label, regionprops
-from scipy import ndimage
+from skimage.measure import label
 import matplotlib.pyplot as plt
 from pathlib import Path
 from tifffile import imread, imwrite
 from csbdeep.utils import plot_history
 from scipy.ndimage import zoom
 from scipy.ndimage import binary_fill_holes
+from concurrent.futures import ProcessPoolExecutor
+from .utils import erode_labels as _erode_labels
 
 
-def erode_labels(segmentation, erosion_iterations=2):
-    # create empty list where the eroded masks can be saved to
-    regions = regionprops(segmentation)
-    erode = np.zeros(segmentation.shape)
-
-    def erode_mask(segmentation_labels, label_id, erosion_iterations):
-
-        only_current_label_id = np.where(segmentation_labels == label_id, 1, 0)
-        eroded = ndimage.binary_erosion(
-            only_current_label_id, iterations=erosion_iterations
-        )
-        relabeled_eroded = np.where(eroded == 1, label_id, 0)
-        return relabeled_eroded
-
-    for i in range(len(regions)):
-        label_id = regions[i].label
-        erode = erode + erode_mask(segmentation, label_id, erosion_iterations)
-
-    # convert list of numpy arrays to stacked numpy array
-    return erode
+def erode_labels(segmentation, erosion_iterations=2, n_workers=None):
+    # every label is eroded on its own bounding box crop, output is uint16
+    return _erode_labels(
+        segmentation.astype(np.uint16, copy=False),
+        erosion_iterations,
+        n_workers=n_workers,
+    )
 
 
 class SmartSeeds3D:
@@ -83,6 +73,8 @@ class SmartSeeds3D:
         n_rays=16,
         epochs=400,
         learning_rate=0.0001,
+        cache_dir=None,
+        n_workers=None,
     ):
 
         self.npz_filename = npz_filename
@@ -126,6 +118,10 @@ class SmartSeeds3D:
         self.acceptable_formats = [".tif", ".TIFF", ".TIF", ".png"]
         self.axis_norm = (0, 1, 2)
         self.axes = "ZYXC"
+        self.cache_dir = (
+            None if cache_dir is None else os.path.join(self.base_dir, cache_dir)
+        )
+        self.n_workers = n_workers
         self.Train()
 
     class UnetSequencer(Sequence):
@@ -136,6 +132,8 @@ class SmartSeeds3D:
             axis_norm,
             batch_size=1,
             shape=(16, 256, 256),
+            cache_dir=None,
+            n_workers=None,
         ):
             super().__init__()
 
@@ -144,12 +142,48 @@ class SmartSeeds3D:
             self.axis_norm = axis_norm
             self.batch_size = batch_size
             self.shape = shape
+            self.cache_dir = cache_dir
+            if cache_dir is not None:
+                # preprocess once, keep only pairs of the training shape
+                cacheraw = build_cache(filesraw, "raw", axis_norm, cache_dir, n_workers)
+                cachemask = build_cache(
+                    filesmask, "mask", axis_norm, cache_dir, n_workers
+                )
+                pairs = [
+                    (raw, mask)
+                    for raw, mask in zip(cacheraw, cachemask)
+                    if cache_shape(raw) == tuple(shape)
+                    and cache_shape(mask) == tuple(shape)
+                ]
+                if len(pairs) < len(cacheraw):
+                    print(
+                        f"Skipping {len(cacheraw) - len(pairs)} samples not of shape {shape}"
+                    )
+                self.cacheraw = [raw for raw, _ in pairs]
+                self.cachemask = [mask for _, mask in pairs]
 
         def __len__(self):
+            if self.cache_dir is not None:
+                return len(self.cacheraw) // self.batch_size
             return len(self.filesraw) // self.batch_size
 
+        def _load_cached(self, idx):
+
+            batch = slice(idx * self.batch_size, (idx + 1) * self.batch_size)
+            return (
+                np.stack([np.load(f) for f in self.cacheraw[batch]]).astype(
+                    np.float32, copy=False
+                ),
+                np.stack([np.load(f) for f in self.cachemask[batch]]).astype(
+                    np.float32
+                ),
+            )
+
         def __getitem__(self, idx):
 
+            if self.cache_dir is not None:
+                return self._load_cached(idx)
+
             batch_x = self.filesraw[idx * self.batch_size : (idx + 1) * self.batch_size]
             batch_y = self.filesmask[
                 idx * self.batch_size : (idx + 1) * self.batch_size
@@ -181,6 +215,8 @@ class SmartSeeds3D:
             normalize=True,
             label_me=False,
             binary_me=False,
+            cache_dir=None,
+            n_workers=None,
         ):
             super().__init__()
 
@@ -190,12 +226,24 @@ class SmartSeeds3D:
             self.label_me = label_me
             self.binary_me = binary_me
             self.normalize = normalize
+            self.cache_dir = cache_dir
+            if cache_dir is not None:
+                kind = ("binary" if binary_me else "label") if label_me else "raw"
+                self.cachefiles = build_cache(
+                    files, kind, axis_norm, cache_dir, n_workers
+                )
 
         def __len__(self):
             return len(self.files)
 
+        def _load_cached(self, i):
+
+            return np.load(self.cachefiles[i])
+
         def __getitem__(self, i):
 
+            if self.cache_dir is not None:
+                return self._load_cached(i)
             # Read raw images
             if self.normalize is True:
                 x = read_float(self.files[i])
@@ -240,24 +288,21 @@ class SmartSeeds3D:
                 glob.glob(self.base_dir + self.binary_mask_dir + "*" + self.pattern)
             )
 
-            for fname in mask:
-                if any(fname.endswith(f) for f in self.acceptable_formats):
-                    image = imread(os.path.join(self.base_dir, fname))
-
-                    Name = os.path.basename(os.path.splitext(fname)[0])
-                    if np.max(image) == 1:
-                        image = image * 255
-                    binary_image = label(image)
-                    if self.real_mask_dir is not None:
-                        imwrite(
+            if self.real_mask_dir is not None:
+                jobs = []
+                for fname in mask:
+                    if any(fname.endswith(f) for f in self.acceptable_formats):
+                        Name = os.path.basename(os.path.splitext(fname)[0])
+                        jobs.append(
                             (
+                                os.path.join(self.base_dir, fname),
                                 os.path.join(
                                     self.base_dir,
                                     self.real_mask_dir + Name + self.pattern,
-                                )
-                            ),
-                            binary_image.astype("uint16"),
+                                ),
+                            )
                         )
+                prepare_masks(jobs, label_binary_mask, n_workers=self.n_workers)
 
         if (
             self.real_mask_dir is not None
@@ -268,26 +313,22 @@ class SmartSeeds3D:
 
             real_files_mask = os.listdir(real_mask_path)
 
-            for fname in real_files_mask:
-                if any(fname.endswith(f) for f in self.acceptable_formats):
-                    image = imread(os.path.join(real_mask_path, fname))
-                    if self.erosion_iterations > 0:
-                        image = erode_labels(
-                            image.astype("uint16"), self.erosion_iterations
-                        )
-                    Name = os.path.basename(os.path.splitext(fname)[0])
-
-                    binary_image = image > 0
-                    if self.binary_mask_dir is not None:
-                        imwrite(
+            if self.binary_mask_dir is not None:
+                jobs = []
+                for fname in real_files_mask:
+                    if any(fname.endswith(f) for f in self.acceptable_formats):
+                        Name = os.path.basename(os.path.splitext(fname)[0])
+                        jobs.append(
                             (
+                                os.path.join(real_mask_path, fname),
                                 os.path.join(
                                     self.base_dir,
                                     self.binary_mask_dir + Name + self.pattern,
-                                )
-                            ),
-                            binary_image.astype("uint16"),
+                                ),
+                                self.erosion_iterations,
+                            )
                         )
+                prepare_masks(jobs, binarize_label_mask, n_workers=self.n_workers)
 
         if self.generate_npz:
 
@@ -345,6 +386,8 @@ class SmartSeeds3D:
                     self.axis_norm,
                     self.batch_size,
                     self.patch_size,
+                    cache_dir=self.cache_dir,
+                    n_workers=self.n_workers,
                 )
 
                 XY_val = self.UnetSequencer(
@@ -353,6 +396,8 @@ class SmartSeeds3D:
                     self.axis_norm,
                     self.batch_size,
                     self.patch_size,
+                    cache_dir=self.cache_dir,
+                    n_workers=self.n_workers,
                 )
 
             config = Config(
@@ -489,6 +534,8 @@ class SmartSeeds3D:
                     self.axis_norm,
                     normalize=True,
                     label_me=False,
+                    cache_dir=self.cache_dir,
+                    n_workers=self.n_workers,
                 )
                 real_mask_path_list = []
                 for fname in real_mask:
@@ -506,6 +553,8 @@ class SmartSeeds3D:
                     self.axis_norm,
                     normalize=False,
                     label_me=True,
+                    cache_dir=self.cache_dir,
+                    n_workers=self.n_workers,
                 )
 
                 self.X_val = self.DataSequencer(
@@ -513,12 +562,16 @@ class SmartSeeds3D:
                     self.axis_norm,
                     normalize=True,
                     label_me=False,
+                    cache_dir=self.cache_dir,
+                    n_workers=self.n_workers,
                 )
                 self.Y_val = self.DataSequencer(
                     val_real_mask_path_list,
                     self.axis_norm,
                     normalize=False,
                     label_me=True,
+                    cache_dir=self.cache_dir,
+                    n_workers=self.n_workers,
                 )
                 self.train_sample_cache = False
 
@@ -659,6 +712,116 @@ def read_int(fname):
     return imread(fname).astype("uint16")
 
 
+def _up_to_date(source, target):
+
+    if not os.path.exists(target):
+        return False
+    return os.path.getmtime(target) >= os.path.getmtime(source)
+
+
+def label_binary_mask(fname, out_file):
+
+    image = imread(fname)
+    if np.max(image) == 1:
+        image = image * 255
+    imwrite(out_file, label(image).astype("uint16"))
+
+
+def binarize_label_mask(fname, out_file, erosion_iterations):
+
+    image = read_int(fname)
+    if erosion_iterations > 0:
+        image = erode_labels(image, erosion_iterations)
+    imwrite(out_file, (image > 0).astype("uint16"))
+
+
+def prepare_masks(jobs, function, n_workers=None):
+    """
+    Runs function(source, target, *args) for every (source, target, *args) job
+    on a process pool, skipping targets newer than their source
+    """
+    jobs = [job for job in jobs if not _up_to_date(job[0], job[1])]
+    if len(jobs) == 0:
+        return
+    print(f"Writing {len(jobs)} masks")
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        list(executor.map(function, *zip(*jobs)))
+
+
+_NORMALIZE_PERCENTILES = (1, 99.8)
+
+
+def _cache_file(fname, kind, axis_norm, cache_dir):
+
+    # keyed on the source file, its size and mtime and the preprocessing, so
+    # same-named files of other folders or an edited source never share one
+    source = Path(fname).resolve()
+    stat = source.stat()
+    key = [
+        source.as_posix(),
+        stat.st_size,
+        stat.st_mtime_ns,
+        kind,
+        list(axis_norm),
+        _NORMALIZE_PERCENTILES,
+    ]
+    digest = hashlib.sha1(json.dumps(key).encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, f"{source.stem}_{kind}_{digest}.npy")
+
+
+def _preprocess(fname, kind, axis_norm, cache_file):
+
+    if kind == "raw":
+        image = normalize(read_float(fname), *_NORMALIZE_PERCENTILES, axis=axis_norm)
+        image = image.astype(np.float32)
+    elif kind == "mask":
+        image = binary_fill_holes(read_int(fname) > 0).astype(np.uint8)
+    elif kind == "binary":
+        image = (read_int(fname) > 0).astype(np.uint16)
+    else:
+        image = read_int(fname)
+    # write then rename, so an interrupted build leaves no partial entry
+    tmp_file = cache_file[: -len(".npy")] + ".tmp.npy"
+    np.save(tmp_file, image)
+    os.replace(tmp_file, cache_file)
+    return cache_file
+
+
+def build_cache(files, kind, axis_norm, cache_dir, n_workers=None):
+    """
+    Preprocesses files once into .npy files of cache_dir with a process pool
+    and returns the cache file of every input file. Raw images are stored
+    normalized as float32, Unet masks hole filled as uint8 and label images
+    as uint16. An entry is reused while its source path, size, mtime and the
+    preprocessing parameters are unchanged.
+    """
+    Path(cache_dir).mkdir(parents=True, exist_ok=True)
+    cachefiles = [_cache_file(fname, kind, axis_norm, cache_dir) for fname in files]
+    todo = [
+        (fname, cache_file)
+        for fname, cache_file in zip(files, cachefiles)
+        if not os.path.exists(cache_file)
+    ]
+    if len(todo) > 0:
+        print(f"Caching {len(todo)} {kind} images in {cache_dir}")
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            list(
+                executor.map(
+                    _preprocess,
+                    [fname for fname, _ in todo],
+                    [kind] * len(todo),
+                    [axis_norm] * len(todo),
+                    [cache_file for _, cache_file in todo],
+                )
+            )
+    return cachefiles
+
+
+def cache_shape(cache_file):
+
+    return np.load(cache_file, mmap_mode="r").shape
+
+
 def DownsampleData(image, downsample_factor):
 
     scale_percent = int(100 / downsample_factor)  # percent of original size
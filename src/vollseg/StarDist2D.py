@@ -7,7 +7,14 @@ Created on Mon Jan  3 19:36:44 2022
 
 from stardist.models import StarDist2D
 
-from .pretrained import get_registered_models, get_model_details, get_model_instance
+from .pretrained import (
+    get_registered_models,
+    get_model_details,
+    get_model_instance,
+    register_model,
+    register_aliases,
+    clear_models_and_aliases,
+)
 import sys
 
 
@@ -133,3 +140,15 @@ class StarDist2D(StarDist2D):
         )
 
         return res_instances, prob, dist
+
+
+clear_models_and_aliases(StarDist2D)
+
+register_model(
+    StarDist2D,
+    "White_Blood_Cells",
+    "https://zenodo.org/record/5815521/files/WBCSeg.zip",
+    "7889f5902d8562766a4dee2726c90d49",
+)
+
+register_aliases(StarDist2D, "White_Blood_Cells", "White_Blood_Cells")
@@ -8,6 +8,9 @@ from .pretrained import (
     get_registered_models,
     get_model_details,
     get_model_instance,
+    register_model,
+    register_aliases,
+    clear_models_and_aliases,
 )
 import sys
 
@@ -132,3 +135,15 @@ class StarDist3D(StarDist3D):
         )
 
         return res_instances, prob, dist
+
+
+clear_models_and_aliases(StarDist3D)
+
+register_model(
+    StarDist3D,
+    "Carcinoma_cells",
+    "https://zenodo.org/record/6354077/files/carcinoma_stardist.zip",
+    "b92b9d5347862e52279629be575fe0b7",
+)
+
+register_aliases(StarDist3D, "Carcinoma_cells", "Carcinoma_cells")
@@ -1,13 +1,20 @@
+import itertools
 import math
 import typing
-from typing import List, Iterable, Tuple
+from typing import Iterable, Tuple
 
-import cv2
 import numpy as np
 import torch
 
+from .Tiles_ND import read_patch
 
-__all__ = ["ImageSlicer", "TileMerger", "compute_pyramid_patch_weight_loss"]
+
+__all__ = [
+    "ImageSlicer",
+    "TileMerger",
+    "VolumeMerger",
+    "compute_pyramid_patch_weight_loss",
+]
 
 
 def compute_pyramid_patch_weight_loss(width: int, height: int) -> np.ndarray:
@@ -189,64 +196,33 @@ class ImageSlicer:
         self.bbox_crops = np.array(bbox_crops)
 
     def iter_split(
-        self, image: np.ndarray, border_type=cv2.BORDER_CONSTANT, value=0
+        self, image: np.ndarray, border_type="constant", value=0
     ) -> Iterable[Tuple[np.ndarray, Tuple[int, int, int, int]]]:
         if (image.shape[0] != self.image_height) or (
             image.shape[1] != self.image_width
         ):
             raise ValueError()
 
-        orig_shape_len = len(image.shape)
-
         for coords, crop_coords in zip(self.crops, self.bbox_crops):
             x, y, tile_width, tile_height = crop_coords
-            x1 = max(x, 0)
-            y1 = max(y, 0)
-            x2 = min(image.shape[1], x + tile_width)
-            y2 = min(image.shape[0], y + tile_height)
-
-            tile = image[y1:y2, x1:x2]  # .copy()
-            if (
-                x < 0
-                or y < 0
-                or (x + tile_width) > image.shape[1]
-                or (y + tile_height) > image.shape[0]
-            ):
-                tile = cv2.copyMakeBorder(
-                    tile,
-                    top=max(0, -y),
-                    bottom=max(0, y + tile_height - image.shape[0]),
-                    left=max(0, -x),
-                    right=max(0, x + tile_width - image.shape[1]),
-                    borderType=border_type,
-                    value=value,
-                )
-
-                # This check recovers possible lack of last dummy dimension for single-channel images
-                if len(tile.shape) != orig_shape_len:
-                    tile = np.expand_dims(tile, axis=-1)
+            tile = read_patch(
+                image, (y, x), (tile_height, tile_width), mode=border_type, value=value
+            )
 
             yield tile, coords
 
-    def split(self, image, border_type=cv2.BORDER_CONSTANT, value=0):
+    def split(self, image, border_type="constant", value=0):
         assert image.shape[0] == self.image_height
         assert image.shape[1] == self.image_width
 
-        orig_shape_len = len(image.shape)
-        image = cv2.copyMakeBorder(
+        image = read_patch(
             image,
-            self.margin_top,
-            self.margin_bottom,
-            self.margin_left,
-            self.margin_right,
-            borderType=border_type,
+            (-self.margin_top, -self.margin_left),
+            (self.target_shape[0], self.target_shape[1]),
+            mode=border_type,
             value=value,
         )
 
-        # This check recovers possible lack of last dummy dimension for single-channel images
-        if len(image.shape) != orig_shape_len:
-            image = np.expand_dims(image, axis=-1)
-
         tiles = []
         for x, y, tile_width, tile_height in self.crops:
             tile = image[y : y + tile_height, x : x + tile_width]  # .copy()
@@ -261,42 +237,17 @@ class ImageSlicer:
         self,
         image: np.ndarray,
         slice_index,
-        border_type=cv2.BORDER_CONSTANT,
+        border_type="constant",
         value=0,
     ):
         assert image.shape[0] == self.image_height
         assert image.shape[1] == self.image_width
 
-        orig_shape_len = len(image.shape)
         x, y, tile_width, tile_height = self.bbox_crops[slice_index]
 
-        x1 = max(x, 0)
-        y1 = max(y, 0)
-        x2 = min(image.shape[1], x + tile_width)
-        y2 = min(image.shape[0], y + tile_height)
-
-        tile = image[y1:y2, x1:x2]
-        if (
-            x < 0
-            or y < 0
-            or (x + tile_width) > image.shape[1]
-            or (y + tile_height) > image.shape[0]
-        ):
-            tile = cv2.copyMakeBorder(
-                tile,
-                top=max(0, -y),
-                bottom=max(0, y + tile_height - image.shape[0]),
-                left=max(0, -x),
-                right=max(0, x + tile_width - image.shape[1]),
-                borderType=border_type,
-                value=value,
-            )
-
-            # This check recovers possible lack of last dummy dimension for single-channel images
-            if len(tile.shape) != orig_shape_len:
-                tile = np.expand_dims(tile, axis=-1)
-
-        return tile
+        return read_patch(
+            image, (y, x), (tile_height, tile_width), mode=border_type, value=value
+        )
 
     @property
     def target_shape(self):
@@ -306,34 +257,52 @@ class ImageSlicer:
         )
         return target_shape
 
-    def merge(self, tiles: List[np.ndarray], dtype=np.float32):
-        if len(tiles) != len(self.crops):
+    @property
+    def norm_mask(self) -> np.ndarray:
+        """
+        Sum of the tile weights over the padded image, computed once from the
+        crop layout and shared by every merge and channel
+        """
+        if getattr(self, "_norm_mask", None) is None:
+            norm_mask = np.zeros(self.target_shape, dtype=np.float32)
+            for x, y, tile_width, tile_height in self.crops:
+                norm_mask[y : y + tile_height, x : x + tile_width] += self.weight
+            np.clip(norm_mask, np.finfo(np.float32).eps, None, out=norm_mask)
+            self._norm_mask = norm_mask
+        return self._norm_mask
+
+    def merge(self, tiles: Iterable[np.ndarray], dtype=np.float32):
+        """
+        :param tiles: Tiles in crop order, a list or any iterable so that
+            tiles can be streamed in without being kept in memory
+        :param dtype: Output dtype, accumulation is done in float32 in place
+        """
+        tiles = iter(tiles)
+        first = next(tiles, None)
+        if first is None:
             raise ValueError
 
-        channels = 1 if len(tiles[0].shape) == 2 else tiles[0].shape[2]
-        target_shape = (
-            self.image_height + self.margin_bottom + self.margin_top,
-            self.image_width + self.margin_right + self.margin_left,
-            channels,
-        )
-
-        image = np.zeros(target_shape, dtype=np.float64)
-        norm_mask = np.zeros(target_shape, dtype=np.float64)
-
-        w = np.dstack([self.weight] * channels)
+        channels = 1 if len(first.shape) == 2 else first.shape[2]
+        target_shape = self.target_shape + (channels,)
 
-        for tile, (x, y, tile_width, tile_height) in zip(tiles, self.crops):
-            # print(x, y, tile_width, tile_height, image.shape)
-            image[y : y + tile_height, x : x + tile_width] += tile * w
-            norm_mask[y : y + tile_height, x : x + tile_width] += w
+        image = np.zeros(target_shape, dtype=np.float32)
+        weight = self.weight[..., np.newaxis]
+        weighted = np.empty(self.tile_size + (channels,), dtype=np.float32)
 
-        # print(norm_mask.min(), norm_mask.max())
-        norm_mask = np.clip(
-            norm_mask, a_min=np.finfo(norm_mask.dtype).eps, a_max=None
-        )
-        normalized = np.divide(image, norm_mask).astype(dtype)
-        crop = self.crop_to_orignal_size(normalized)
-        return crop
+        tiles = itertools.chain([first], tiles)
+        for x, y, tile_width, tile_height in self.crops:
+            tile = next(tiles, None)
+            if tile is None:
+                raise ValueError("Fewer tiles than crops")
+            tile = tile.reshape(tile_height, tile_width, -1)
+            np.multiply(tile, weight, out=weighted, casting="unsafe")
+            image[y : y + tile_height, x : x + tile_width] += weighted
+        if next(tiles, None) is not None:
+            raise ValueError("More tiles than crops")
+
+        image /= self.norm_mask[..., np.newaxis]
+        crop = self.crop_to_orignal_size(image)
+        return crop.astype(dtype, copy=False)
 
     def crop_to_orignal_size(self, image):
         assert image.shape[0] == self.target_shape[0]
@@ -384,6 +353,9 @@ class TileMerger:
             device=device,
             dtype=dtype,
         )
+        self.offsets = _tile_offsets(self.image.shape[1:], self.weight.shape[1:]).to(
+            device=device
+        )
 
     def accumulate_single(self, tile: torch.Tensor, coords):
         """
@@ -418,13 +390,10 @@ class TileMerger:
         if batch.dtype != self.image.dtype:
             batch = batch.type_as(self.image)
 
-        for tile, (x, y, tile_width, tile_height) in zip(batch, crop_coords):
-            self.image[:, y : y + tile_height, x : x + tile_width] += (
-                tile * self.weight
-            )
-            self.norm_mask[
-                :, y : y + tile_height, x : x + tile_width
-            ] += self.weight
+        starts = _as_long_tensor(crop_coords, self.device)[:, [1, 0]]
+        _scatter_tiles(
+            self.image, self.norm_mask, batch, self.weight, self.offsets, starts
+        )
 
     @property
     def device(self) -> torch.device:
@@ -436,3 +405,121 @@ class TileMerger:
     def merge_(self) -> torch.Tensor:
         self.image /= self.norm_mask
         return self.image
+
+
+class VolumeMerger:
+    """
+    Helper class to merge overlapping 3D patch predictions of a VolumeSlicer,
+    weighted by its fading map
+    """
+
+    def __init__(self, slicer, channels, device="cpu", dtype=torch.float32):
+        """
+        :param slicer: VolumeSlicer (or NDSlicer) the patches come from
+        :param channels: Number of channels of the patch predictions
+        """
+        self.slicer = slicer
+        self.channels = channels
+        fading_map = getattr(slicer, "fading_map", None)
+        if fading_map is None:
+            fading_map = slicer.get_fading_map()
+        self.weight = torch.from_numpy(np.expand_dims(fading_map, axis=0)).to(
+            device=device, dtype=dtype
+        )
+
+        # patches may reach over the border, accumulate on a padded volume
+        self.pad_before = np.maximum(slicer.global_crop_before, 0)
+        self.pad_after = np.maximum(-slicer.global_crop_after, 0)
+        shape = tuple(map(int, slicer.data_shape + self.pad_before + self.pad_after))
+        self.image = torch.zeros((channels,) + shape, device=device, dtype=dtype)
+        self.norm_mask = torch.zeros((1,) + shape, device=device, dtype=dtype)
+        self.offsets = _tile_offsets(shape, self.weight.shape[1:]).to(device=device)
+
+    def integrate_batch(self, batch: torch.Tensor, patch_start):
+        """
+        Accumulates batch of patch predictions
+        :param batch: Predicted patches of shape [B,C,Z,Y,X]
+        :param patch_start: Corresponding patch starts w.r.t to the original
+            volume, as returned by PredictTiled, shape [B,3]
+        """
+        if len(batch) != len(patch_start):
+            raise ValueError(
+                "Number of images in batch does not correspond to number of coordinates"
+            )
+
+        if batch.device != self.image.device:
+            batch = batch.to(device=self.image.device)
+
+        if batch.dtype != self.image.dtype:
+            batch = batch.type_as(self.image)
+
+        starts = _as_long_tensor(patch_start, self.device) + _as_long_tensor(
+            self.pad_before, self.device
+        )
+        _scatter_tiles(
+            self.image, self.norm_mask, batch, self.weight, self.offsets, starts
+        )
+
+    @property
+    def device(self) -> torch.device:
+        return self.image.device
+
+    def merge(self) -> torch.Tensor:
+        return self._crop(self.image / self.norm_mask)
+
+    def merge_(self) -> torch.Tensor:
+        self.image /= self.norm_mask
+        return self._crop(self.image)
+
+    def _crop(self, image):
+
+        return image[
+            (slice(None),)
+            + tuple(
+                slice(b, b + s) for b, s in zip(self.pad_before, self.slicer.data_shape)
+            )
+        ]
+
+
+def _tile_offsets(image_shape, tile_shape) -> torch.Tensor:
+    """
+    Flat offsets of every tile pixel in a C-contiguous image of image_shape
+    """
+    strides = np.cumprod((1,) + tuple(image_shape[:0:-1]))[::-1]
+    offsets = np.zeros(tuple(tile_shape), dtype=np.int64)
+    for axis, (size, stride) in enumerate(zip(tile_shape, strides)):
+        shape = [1] * len(tile_shape)
+        shape[axis] = size
+        offsets = offsets + (np.arange(size) * stride).reshape(shape)
+    return torch.from_numpy(offsets.ravel())
+
+
+def _as_long_tensor(coords, device) -> torch.Tensor:
+
+    if not torch.is_tensor(coords):
+        coords = torch.from_numpy(np.asarray(coords, dtype=np.int64))
+    return coords.to(device=device, dtype=torch.long)
+
+
+def _scatter_tiles(image, norm_mask, batch, weight, offsets, starts):
+    """
+    Adds a batch of weighted tiles [B,C,...] starting at starts [B,ndim] to
+    image [C,...] and norm_mask [1,...] with one index_add_ each
+    """
+    channels = image.shape[0]
+    # flat indices of a tile crossing the border would wrap into other rows
+    tile_shape = torch.as_tensor(weight.shape[1:], device=starts.device)
+    image_shape = torch.as_tensor(image.shape[1:], device=starts.device)
+    assert (starts >= 0).all(), "Tiles start outside the image"
+    assert (starts + tile_shape <= image_shape).all(), "Tiles end outside the image"
+    strides = torch.as_tensor(image.stride()[1:], device=image.device)
+    base = (starts * strides).sum(dim=1)
+    index = (base[:, None] + offsets[None, :]).reshape(-1)
+
+    weighted = (batch * weight).reshape(len(batch), channels, -1)
+    image.view(channels, -1).index_add_(
+        1, index, weighted.transpose(0, 1).reshape(channels, -1)
+    )
+    norm_mask.view(1, -1).index_add_(
+        1, index, weight.reshape(1, -1).repeat(1, len(batch))
+    )
@@ -0,0 +1,222 @@
+import itertools
+from typing import Sequence, Tuple, Union
+
+import numpy as np
+from scipy.ndimage import distance_transform_edt
+
+__all__ = ["NDSlicer", "NDMerger", "read_patch"]
+
+# cv2 border types accepted by ImageSlicer, mapped to np.pad modes
+BORDER_MODES = {
+    0: "constant",
+    1: "edge",
+    2: "symmetric",
+    3: "wrap",
+    4: "reflect",
+}
+
+
+def read_patch(data, start, size, mode="reflect", value=0):
+    """
+    Read the window [start, start + size) over the first len(size) axes of data.
+
+    Only the part of the window inside the data is read, so memmaps, dask and
+    zarr arrays are never loaded beyond the window. Windows inside a NumPy
+    array come back as views, border windows are filled as np.pad mode (or a
+    cv2 border type) would fill them when padding the whole array, using
+    value for the constant mode.
+    """
+    mode = BORDER_MODES.get(mode, mode)
+    start = np.asarray(start, dtype=int)
+    end = start + np.asarray(size, dtype=int)
+    shape = np.asarray(data.shape[: len(start)])
+    pad_before = np.maximum(-start, 0)
+    pad_after = np.maximum(end - shape, 0)
+
+    if mode == "constant" and ((start >= shape) | (end <= 0)).any():
+        # nothing of the window lies inside the data
+        return np.full(
+            tuple(end - start) + data.shape[len(start) :], value, dtype=data.dtype
+        )
+    if mode == "constant" or not (pad_before.any() or pad_after.any()):
+        slicing = tuple(map(slice, np.maximum(start, 0), np.minimum(end, shape)))
+        patch = data[slicing]
+        if not isinstance(patch, np.ndarray):
+            patch = np.asarray(patch)
+        if pad_before.any() or pad_after.any():
+            pad_width = list(zip(pad_before, pad_after))
+            pad_width += [(0, 0)] * (patch.ndim - len(start))
+            patch = np.pad(patch, pad_width, constant_values=value)
+        return patch
+
+    # source index of every output pixel, read once as its bounding window
+    index = [
+        np.pad(np.arange(n), (b, a), mode=mode)[s + b : e + b]
+        for n, b, a, s, e in zip(shape, pad_before, pad_after, start, end)
+    ]
+    low = [i.min() for i in index]
+    slicing = tuple(slice(lo, i.max() + 1) for lo, i in zip(low, index))
+    patch = np.asarray(data[slicing])
+    return patch[np.ix_(*[i - lo for i, lo in zip(index, low)])]
+
+
+def _as_size(value, ndim, name):
+
+    if isinstance(value, (tuple, list, np.ndarray)):
+        if len(value) != ndim:
+            raise ValueError(f"{name} must have exactly {ndim} elements. Got: {value}")
+        return np.array(value, dtype=int)
+    return np.array([int(value)] * ndim)
+
+
+class NDSlicer:
+    """
+    Helper class to slice an N-dimensional array into overlapping patches and merge them back
+    """
+
+    def __init__(
+        self,
+        data,
+        patch_size: Union[int, Sequence[int]],
+        overlap: Union[int, Sequence[int]],
+        crop: Union[int, Sequence[int]],
+        pad_mode="reflect",
+    ):
+        """
+        :param data: Source array, any object with shape, ndim and NumPy slicing
+            (ndarray, memmap, dask or zarr array). Patches run over its first
+            len(patch_size) axes, trailing axes are taken whole.
+        :param patch_size: Patch size (Scalar or tuple)
+        :param overlap: Overlap between the cropped patches (Scalar or tuple)
+        :param crop: Border discarded from every patch (Scalar or tuple)
+        :param pad_mode: np.pad mode for patches reaching over the border
+        """
+        self.data = data
+        if isinstance(patch_size, (tuple, list, np.ndarray)):
+            self.ndim = len(patch_size)
+        else:
+            self.ndim = data.ndim
+        self.data_shape = np.array(data.shape[: self.ndim])
+        self.patch_size = _as_size(patch_size, self.ndim, "patch_size")
+        self.overlap = _as_size(overlap, self.ndim, "overlap")
+        self.crop = _as_size(crop, self.ndim, "crop")
+        self.pad_mode = pad_mode
+
+        assert all(
+            [
+                p - 2 * o - 2 * c > 0
+                for p, o, c in zip(self.patch_size, self.overlap, self.crop)
+            ]
+        ), "Invalid combination of patch size, overlap and crop size."
+        # Calculate the position of each tile
+        locations = []
+        for i, p, o, c in zip(
+            self.data_shape, self.patch_size, self.overlap, self.crop
+        ):
+            # get starting coords
+            step = max(p - o - 2 * c, 1)
+            coords = np.arange(int(np.ceil((i + o + c) / step)), dtype=np.int64)
+            locations.append(coords * step - o - c)
+        self.locations = list(itertools.product(*locations))
+        self.global_crop_before = np.abs(np.min(np.array(self.locations), axis=0))
+        self.global_crop_after = (
+            np.array(self.data_shape)
+            - np.max(np.array(self.locations), axis=0)
+            - np.array(self.patch_size)
+        )
+
+    def __len__(self):
+
+        return len(self.locations)
+
+    def get_patch(self, idx) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        :return: The patch, its start and its end in data coordinates
+        """
+        patch_start = np.array(self.locations[idx])
+        patch_end = patch_start + self.patch_size
+        patch = read_patch(self.data, patch_start, self.patch_size, mode=self.pad_mode)
+        return patch, patch_start, patch_end
+
+    def __iter__(self):
+
+        for idx in range(len(self)):
+            yield self.get_patch(idx)
+
+    def get_fading_map(self):
+
+        fading_map = np.ones(self.patch_size)
+
+        if all([c == 0 for c in self.crop]):
+            self.crop = np.ones(self.ndim, dtype=int)
+
+        # Exclude crop region
+        crop_masking = np.zeros_like(fading_map)
+        crop_masking[
+            tuple(slice(c, p - c) for c, p in zip(self.crop, self.patch_size))
+        ] = 1
+        fading_map = fading_map * crop_masking
+
+        fading_map = distance_transform_edt(fading_map).astype(np.float32)
+
+        # Normalize
+        self.fading_map = fading_map / fading_map.max()
+        return self.fading_map
+
+
+class NDMerger:
+    """
+    Accumulates weighted patches of an NDSlicer into a preallocated output
+    """
+
+    def __init__(self, slicer: NDSlicer, out=None, channels=None, dtype=np.float32):
+        """
+        :param slicer: The slicer the patches come from
+        :param out: Zero initialised output of shape (channels,) + data shape,
+            any array supporting NumPy slicing (ndarray, memmap, zarr).
+            Allocated in memory when not given.
+        :param channels: Number of leading channels in every patch, None for
+            patches shaped like the slicer patches
+        """
+        self.slicer = slicer
+        self.channels = channels
+        self.weight = getattr(slicer, "fading_map", None)
+        if self.weight is None:
+            self.weight = slicer.get_fading_map()
+        channel_shape = () if channels is None else (channels,)
+        shape = channel_shape + tuple(slicer.data_shape)
+        self.image = np.zeros(shape, dtype=dtype) if out is None else out
+        self.norm_mask = np.zeros(tuple(slicer.data_shape), dtype=np.float32)
+
+    def add(self, patch, patch_start):
+        """
+        :param patch: Patch prediction with optional leading channel axis
+        :param patch_start: Start of the patch in data coordinates
+        """
+        patch_start = np.asarray(patch_start, dtype=int)
+        patch_end = patch_start + self.slicer.patch_size
+        start = np.maximum(patch_start, 0)
+        end = np.minimum(patch_end, self.slicer.data_shape)
+        if np.any(end <= start):
+            return
+        target = tuple(map(slice, start, end))
+        source = tuple(map(slice, start - patch_start, end - patch_start))
+        weight = self.weight[source]
+        patch = np.asarray(patch)[(Ellipsis,) + source]
+
+        self.image[(Ellipsis,) + target] += patch * weight
+        self.norm_mask[target] += weight
+
+    def merge(self):
+        """
+        Normalises the accumulated output in place and returns it
+        """
+        norm_mask = np.clip(self.norm_mask, a_min=np.finfo(np.float32).eps, a_max=None)
+        if isinstance(self.image, np.ndarray):
+            self.image /= norm_mask
+        else:
+            # blockwise along the first data axis for on-disk outputs
+            for i in range(norm_mask.shape[0]):
+                index = (Ellipsis, i) + (slice(None),) * (self.slicer.ndim - 1)
+                self.image[index] = self.image[index] / norm_mask[i]
+        return self.image
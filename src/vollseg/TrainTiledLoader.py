@@ -23,6 +23,7 @@ class TrainTiled(Dataset):
         patches_from_fg=0.0,
         dist_handling="bool_inv",
         correspondence=True,
+        fg_samples_per_slab=1024,
     ):
 
         # Sanity checks
@@ -35,6 +36,7 @@ class TrainTiled(Dataset):
         self.patches_from_fg = patches_from_fg
         self.dist_handling = dist_handling
         self.correspondence = correspondence
+        self.fg_samples_per_slab = fg_samples_per_slab
 
         self.samples_per_epoch = samples_per_epoch
         self.axis_norm = (0, 1, 2)
@@ -43,6 +45,78 @@ class TrainTiled(Dataset):
         self.mask_groups = mask_groups
         self.data_list = self._read_list()
 
+        # HDF5 handles are opened lazily in every worker, foreground indices
+        # are built once per file
+        self._handles = {}
+        self._handles_pid = None
+        self._fg_index = {}
+
+    def __getstate__(self):
+
+        state = self.__dict__.copy()
+        state["_handles"] = {}
+        state["_handles_pid"] = None
+        return state
+
+    def _h5(self, path):
+
+        # handles inherited from another process are not usable
+        if self._handles_pid != os.getpid():
+            self._handles = {}
+            self._handles_pid = os.getpid()
+        if path not in self._handles:
+            self._handles[path] = h5py.File(path, "r")
+        return self._handles[path]
+
+    def close(self):
+
+        if self._handles_pid == os.getpid():
+            for f_handle in self._handles.values():
+                f_handle.close()
+        self._handles = {}
+
+    def foreground_index(self, path):
+        """
+        Compact foreground index of the first mask group of a file: up to
+        fg_samples_per_slab nonzero coordinates of every chunk-row slab, with
+        sampling probabilities proportional to the true slab foreground
+        """
+        if path not in self._fg_index:
+            mask = self._h5(path)[self.mask_groups[0]]
+            step = mask.chunks[0] if mask.chunks else 1
+            coords, weights = [], []
+            for z in range(0, mask.shape[0], step):
+                fg = np.argwhere(mask[z : z + step])
+                if len(fg) == 0:
+                    continue
+                count = len(fg)
+                if count > self.fg_samples_per_slab:
+                    keep = np.random.choice(
+                        count, self.fg_samples_per_slab, replace=False
+                    )
+                    fg = fg[keep]
+                fg[:, 0] += z
+                coords.append(fg.astype(np.int32))
+                weights.append(np.full(len(fg), count / len(fg)))
+            if len(coords) > 0:
+                coords = np.concatenate(coords)
+                weights = np.concatenate(weights)
+                weights /= weights.sum()
+            else:
+                coords = np.zeros((0, mask.ndim), dtype=np.int32)
+                weights = np.zeros(0)
+            self._fg_index[path] = (coords, weights)
+        return self._fg_index[path]
+
+    def precompute_foreground(self):
+        """
+        Builds the foreground index of every mask file, call before handing
+        the dataset to a DataLoader so that workers inherit it
+        """
+        if self.patches_from_fg > 0:
+            for filepath in self.data_list:
+                self.foreground_index(filepath[1])
+
     def test(self, test_folder="", num_files=20):
 
         os.makedirs(test_folder, exist_ok=True)
@@ -118,96 +192,107 @@ class TrainTiled(Dataset):
         mask = np.zeros(
             (len(self.mask_groups),) + self.patch_size, dtype=np.float32
         )
-        with h5py.File(filepath[1], "r") as f_handle:
-            for num_group, group_name in enumerate(self.mask_groups):
-
-                mask_tmp = f_handle[group_name]
-
-                # determine the patch position for the first mask
-                if num_group == 0:
-
-                    # obtain patch position from foreground indices or random
-                    if self.patches_from_fg > np.random.random():
-                        fg_indices = np.where(mask_tmp)
-                        rnd_start = [
-                            np.maximum(
-                                0,
-                                f[np.random.randint(len(fg_indices[0]))] - p,
-                            )
-                            for f, p in zip(fg_indices, patch_size)
-                        ]
-                    else:
-                        rnd_start = [
-                            np.random.randint(
-                                0, np.maximum(1, mask_dim - patch_dim)
-                            )
-                            for patch_dim, mask_dim in zip(
-                                patch_size, mask_tmp.shape
-                            )
-                        ]
-                    rnd_end = [
-                        start + patch_dim
-                        for start, patch_dim in zip(rnd_start, patch_size)
-                    ]
-                    slicing = tuple(map(slice, rnd_start, rnd_end))
+        f_handle = self._h5(filepath[1])
+        for num_group, group_name in enumerate(self.mask_groups):
+
+            mask_tmp = f_handle[group_name]
 
-                # extract the patch
-                mask_tmp = mask_tmp[slicing]
+            # determine the patch position for the first mask
+            if num_group == 0:
 
-                # Pad if neccessary
-                pad_width = [
-                    (0, np.maximum(0, p - i))
-                    for p, i in zip(patch_size, mask_tmp.shape)
+                # obtain patch position from foreground indices or random
+                fg_indices, fg_weights = (
+                    self.foreground_index(filepath[1])
+                    if self.patches_from_fg > np.random.random()
+                    else (None, None)
+                )
+                if fg_indices is not None and len(fg_indices) > 0:
+                    fg = fg_indices[
+                        np.random.choice(len(fg_indices), p=fg_weights)
+                    ]
+                    # place the foreground voxel anywhere inside the patch,
+                    # keeping the patch inside the image where it fits
+                    rnd_start = [
+                        np.minimum(
+                            np.maximum(0, f - np.random.randint(p)),
+                            np.maximum(0, mask_dim - p),
+                        )
+                        for f, p, mask_dim in zip(
+                            fg, patch_size, mask_tmp.shape
+                        )
+                    ]
+                else:
+                    rnd_start = [
+                        np.random.randint(
+                            0, np.maximum(1, mask_dim - patch_dim)
+                        )
+                        for patch_dim, mask_dim in zip(
+                            patch_size, mask_tmp.shape
+                        )
+                    ]
+                rnd_end = [
+                    start + patch_dim
+                    for start, patch_dim in zip(rnd_start, patch_size)
                 ]
-                mask_tmp = np.pad(mask_tmp, pad_width, mode="reflect")
+                slicing = tuple(map(slice, rnd_start, rnd_end))
+
+            # extract the patch
+            mask_tmp = mask_tmp[slicing]
 
-                # Store current mask
-                mask[num_group, ...] = mask_tmp
+            # Pad if neccessary
+            pad_width = [
+                (0, np.maximum(0, p - i))
+                for p, i in zip(patch_size, mask_tmp.shape)
+            ]
+            mask_tmp = np.pad(mask_tmp, pad_width, mode="reflect")
 
-            mask = mask.astype(np.float32)
+            # Store current mask
+            mask[num_group, ...] = mask_tmp
 
-            sample["mask"] = mask
+        mask = mask.astype(np.float32)
+
+        sample["mask"] = mask
 
         # Load the image patch
         image = np.zeros(
             (len(self.image_groups),) + self.patch_size, dtype=np.float32
         )
-        with h5py.File(filepath[0], "r") as f_handle:
-            for num_group, group_name in enumerate(self.image_groups):
-
-                image_tmp = f_handle[group_name]
-                # Check if positioning  have to be reset
-                reset = (not self.correspondence) and num_group == 0
-
-                # Determine the patch position
-                if reset:
-                    rnd_start = [
-                        np.random.randint(
-                            0, np.maximum(1, image_dim - patch_dim)
-                        )
-                        for patch_dim, image_dim in zip(
-                            patch_size, image_tmp.shape
-                        )
-                    ]
-                    rnd_end = [
-                        start + patch_dim
-                        for start, patch_dim in zip(rnd_start, patch_size)
-                    ]
-                    slicing = tuple(map(slice, rnd_start, rnd_end))
-                image_tmp = image_tmp[slicing].astype(np.float32)
-
-                # Pad if neccessary
-                pad_width = [
-                    (0, np.maximum(0, p - i))
-                    for p, i in zip(patch_size, image_tmp.shape)
+        f_handle = self._h5(filepath[0])
+        for num_group, group_name in enumerate(self.image_groups):
+
+            image_tmp = f_handle[group_name]
+            # Check if positioning  have to be reset
+            reset = (not self.correspondence) and num_group == 0
+
+            # Determine the patch position
+            if reset:
+                rnd_start = [
+                    np.random.randint(
+                        0, np.maximum(1, image_dim - patch_dim)
+                    )
+                    for patch_dim, image_dim in zip(
+                        patch_size, image_tmp.shape
+                    )
+                ]
+                rnd_end = [
+                    start + patch_dim
+                    for start, patch_dim in zip(rnd_start, patch_size)
                 ]
-                image_tmp = np.pad(image_tmp, pad_width, mode="reflect")
+                slicing = tuple(map(slice, rnd_start, rnd_end))
+            image_tmp = image_tmp[slicing].astype(np.float32)
+
+            # Pad if neccessary
+            pad_width = [
+                (0, np.maximum(0, p - i))
+                for p, i in zip(patch_size, image_tmp.shape)
+            ]
+            image_tmp = np.pad(image_tmp, pad_width, mode="reflect")
 
-                # Permute dimensions
-                image[num_group, ...] = image_tmp
+            # Permute dimensions
+            image[num_group, ...] = image_tmp
 
-            image = image.astype(np.float32)
+        image = image.astype(np.float32)
 
-            sample["image"] = image
+        sample["image"] = image
 
         return sample
@@ -1,5 +1,12 @@
 from csbdeep.models import CARE
-from .pretrained import get_registered_models, get_model_details, get_model_instance
+from .pretrained import (
+    get_registered_models,
+    get_model_details,
+    get_model_instance,
+    register_model,
+    register_aliases,
+    clear_models_and_aliases,
+)
 import sys
 
 # if IS_TF_1:
@@ -66,3 +73,61 @@ class UNET(CARE):
                 )
                 sys.stderr.flush()
             get_registered_models(cls, verbose=True)
+
+
+clear_models_and_aliases(UNET)
+
+register_model(
+    UNET,
+    "Embryo Cell Model (3D)",
+    "https://zenodo.org/record/6337699/files/embryo_cell_model.zip",
+    "c84fdec38a5b3cc6c1869c94ff23f3ba",
+)
+register_model(
+    UNET,
+    "Xenopus Tissue (2D)",
+    "https://zenodo.org/record/6060378/files/Xenopus_tissue_model.zip",
+    "2694d8b05fa828aceb055eef8cd5ca1f",
+)
+register_model(
+    UNET,
+    "Microtubule Kymograph Segmentation",
+    "https://zenodo.org/record/6355705/files/microtubule_kymograph_segmentation.zip",
+    "a42fcd4ba732734d36eda3dbbb3d5673",
+)
+register_model(
+    UNET,
+    "Unet_White_Blood_Cells",
+    "https://zenodo.org/record/5815588/files/UNETWBC.zip",
+    "9645f004db478f661811d6da615ccc0b",
+)
+register_model(
+    UNET,
+    "Unet_Arabidopsis",
+    "https://zenodo.org/record/6670747/files/Unet_Arabidopsis.zip",
+    "ed7bdead6ebb11c3e13c22a156288f60",
+)
+register_model(
+    UNET,
+    "Unet_Cyto_White_Blood_Cells",
+    "https://zenodo.org/record/5815603/files/UNETcytoWBC.zip",
+    "dd3bf8b8e2a04536144954e882445a5e",
+)
+register_model(
+    UNET,
+    "Unet_Lung_Segmentation",
+    "https://zenodo.org/record/6060177/files/Montgomery_county.zip",
+    "be41937a00693e28961358440d242417",
+)
+
+register_aliases(UNET, "Embryo Cell Model (3D)", "Embryo Cell Model (3D)")
+register_aliases(UNET, "Unet_White_Blood_Cells", "Unet_White_Blood_Cells")
+register_aliases(UNET, "Unet_Cyto_White_Blood_Cells", "Unet_Cyto_White_Blood_Cells")
+register_aliases(
+    UNET,
+    "Microtubule Kymograph Segmentation",
+    "Microtubule Kymograph Segmentation",
+)
+register_aliases(UNET, "Xenopus Tissue (2D)", "Xenopus Tissue (2D)")
+register_aliases(UNET, "Unet_Lung_Segmentation", "Unet_Lung_Segmentation")
+register_aliases(UNET, "Unet_Arabidopsis", "Unet_Arabidopsis")
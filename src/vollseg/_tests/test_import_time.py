@@ -0,0 +1,51 @@
+import json
+import subprocess
+import sys
+
+# importing these must not pull in a deep learning or GUI framework
+LIGHT_MODULES = (
+    "vollseg",
+    "vollseg.utils",
+    "vollseg.Tiles_ND",
+    "vollseg.seedpool",
+    "vollseg.nmslabel",
+    "vollseg.matching",
+)
+HEAVY_MODULES = ("torch", "tensorflow", "keras", "napari", "cellpose", "cv2")
+# seconds for the imports alone, about twice their cost with all
+# dependencies installed, interpreter start up is not counted
+IMPORT_BUDGET = 2.0
+RUNS = 3
+
+SCRIPT = f"""
+import json, sys, time
+start = time.perf_counter()
+for module in {LIGHT_MODULES!r}:
+    __import__(module)
+elapsed = time.perf_counter() - start
+heavy = sorted(set({HEAVY_MODULES!r}) & set(sys.modules))
+print(json.dumps({{"elapsed": elapsed, "heavy": heavy}}))
+"""
+
+
+def _import_in_fresh_interpreter():
+
+    # modules imported by other tests do not count
+    result = subprocess.run(
+        [sys.executable, "-c", SCRIPT],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def test_import_is_light():
+
+    runs = [_import_in_fresh_interpreter() for _ in range(RUNS)]
+
+    heavy = runs[0]["heavy"]
+    assert heavy == [], f"Importing vollseg loaded {heavy}"
+    # the fastest run, the others may include a cold file system cache
+    elapsed = min(run["elapsed"] for run in runs)
+    assert elapsed < IMPORT_BUDGET, f"Importing vollseg took {elapsed:.2f} s"
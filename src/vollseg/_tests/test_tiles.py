@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("torch")
+
+import torch  # noqa: E402
+
+from vollseg.Tiles import ImageSlicer, TileMerger  # noqa: E402
+
+
+@pytest.fixture
+def slicer_tiles():
+
+    image = np.random.rand(64, 80).astype(np.float32)
+    slicer = ImageSlicer(image.shape, tile_size=32, tile_step=16)
+    return image, slicer, slicer.split(image)
+
+
+def test_merge_round_trip(slicer_tiles):
+
+    image, slicer, tiles = slicer_tiles
+    merged = slicer.merge(tiles)
+    np.testing.assert_allclose(merged[..., 0], image, rtol=1e-5)
+
+
+@pytest.mark.parametrize("extra", [-1, 1, 2])
+def test_merge_rejects_wrong_tile_count(slicer_tiles, extra):
+
+    _, slicer, tiles = slicer_tiles
+    if extra < 0:
+        tiles = tiles[:extra]
+    else:
+        tiles = tiles + [tiles[0]] * extra
+    with pytest.raises(ValueError):
+        slicer.merge(tiles)
+
+
+@pytest.mark.parametrize("coords", [(72, 0, 16, 16), (0, -4, 16, 16)])
+def test_integrate_batch_rejects_tiles_outside(coords):
+
+    merger = TileMerger((64, 80), 1, np.ones((16, 16), dtype=np.float32))
+    with pytest.raises(AssertionError):
+        merger.integrate_batch(torch.ones((1, 1, 16, 16)), [coords])
@@ -0,0 +1,74 @@
+import hashlib
+import threading
+
+import numpy as np
+
+
+class CachedModel:
+    """
+    Wraps a CARE, UNET or StarDist model so that predict runs the network
+    once per distinct input and serves repeated calls from memory.
+
+    Everything else is delegated to the wrapped model, so the wrapper can be
+    passed to VollSeg in place of the model. Post-processing that depends
+    on thresholds (StarDist NMS, seed pooling, watershed) still runs on
+    every call, only the network outputs are reused. The cache is filled
+    under a lock, so threads share one network run per input.
+    """
+
+    def __init__(self, model):
+
+        self.model = model
+        self.outputs = {}
+        self._lock = threading.Lock()
+
+    @property
+    def __class__(self):
+
+        # keep isinstance checks of the pipeline working
+        return type(self.model)
+
+    def __getattr__(self, name):
+
+        return getattr(self.model, name)
+
+    def key(self, img, *args, **kwargs):
+
+        img = np.ascontiguousarray(img)
+        digest = hashlib.sha1(img.data).hexdigest()
+        return (
+            digest,
+            img.shape,
+            img.dtype.str,
+            repr(args),
+            repr(sorted(kwargs.items())),
+        )
+
+    def predict(self, img, *args, **kwargs):
+
+        key = self.key(img, *args, **kwargs)
+        with self._lock:
+            if key not in self.outputs:
+                self.outputs[key] = self.model.predict(img, *args, **kwargs)
+            output = self.outputs[key]
+        # copies, the pipeline modifies some outputs in place
+        return _copy(output)
+
+    def predict_vollseg(self, img, *args, **kwargs):
+
+        # run the model's own method with self.predict going through the cache
+        return type(self.model).predict_vollseg(self, img, *args, **kwargs)
+
+    def clear(self):
+
+        with self._lock:
+            self.outputs = {}
+
+
+def _copy(output):
+
+    if isinstance(output, np.ndarray):
+        return output.copy()
+    if isinstance(output, (tuple, list)):
+        return type(output)(_copy(o) for o in output)
+    return output
@@ -0,0 +1,221 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+from tifffile import memmap
+
+
+class FrameWriter:
+    """
+    Writes the outputs of a time-lapse segmentation one frame at a time, so
+    no output stack is held in memory.
+
+    Every persisted output goes to save_dir/<output>/<name>.tif as an
+    uncompressed BigTIFF written through a memory map, or with
+    save_format="zarr" to save_dir/<output>/<name>.zarr chunked per frame
+    and compressed with the given numcodecs compressor (zarr's default when
+    None). Outputs that are not persisted are dropped.
+
+    The finished frames are recorded in save_dir/.<name>_frames.json, a
+    writer created again with the same arguments and fingerprint resumes
+    after them. Any other writer starts over.
+    """
+
+    def __init__(
+        self,
+        save_dir,
+        name,
+        outputs,
+        n_frames,
+        persist=None,
+        save_format="bigtiff",
+        compression=None,
+        dtypes=None,
+        fingerprint=None,
+    ):
+        """
+        :param outputs: Names of the frame outputs in the order they are
+            returned, used as folder names
+        :param n_frames: Number of time points
+        :param persist: Outputs to write, all of them when None
+        :param dtypes: Output dtype per name, the frame dtype when missing
+        :param fingerprint: Identifies the input and the parameters the
+            frames are computed from, see frame_fingerprint
+        """
+        if save_format not in ("bigtiff", "zarr"):
+            raise ValueError(f"Unknown save_format {save_format}")
+        if compression is not None and save_format != "zarr":
+            raise ValueError("Compressed output needs save_format='zarr'")
+        self.save_dir = Path(save_dir)
+        self.name = name
+        self.outputs = list(outputs)
+        self.n_frames = n_frames
+        self.persist = set(self.outputs if persist is None else persist)
+        self.persist &= set(self.outputs)
+        self.save_format = save_format
+        self.compression = compression
+        self.dtypes = {} if dtypes is None else dtypes
+        self.fingerprint = fingerprint
+        self.progress_file = self.save_dir / f".{name}_frames.json"
+        self.save_dir.mkdir(parents=True, exist_ok=True)
+
+        self.done = set()
+        if self.progress_file.exists():
+            state = json.loads(self.progress_file.read_text())
+            if state == dict(state, **self.state()):
+                self.done = set(state["frames"])
+        if not all(self.path(output).exists() for output in self.persist):
+            self.done = set()
+        self.stacks = [
+            _FrameStack(self, output) if output in self.persist else _NullStack()
+            for output in self.outputs
+        ]
+
+    def state(self):
+
+        return {
+            "n_frames": self.n_frames,
+            "outputs": sorted(self.persist),
+            "save_format": self.save_format,
+            "fingerprint": self.fingerprint,
+        }
+
+    def path(self, output):
+
+        suffix = ".zarr" if self.save_format == "zarr" else ".tif"
+        return self.save_dir / output / (self.name + suffix)
+
+    def open(self, output, shape=None, dtype=None):
+        """
+        Opens the stack of an output, a new one of shape (n_frames,) + shape
+        when shape is given and no frames are done yet
+        """
+        path = self.path(output)
+        create = shape is not None and not self.done
+        if not create and not path.exists():
+            return None
+        if self.save_format == "zarr":
+            import zarr
+
+            if not create:
+                return zarr.open_array(path.as_posix(), mode="r+")
+            kwargs = {}
+            if self.compression is not None:
+                kwargs["compressor"] = self.compression
+            return zarr.open_array(
+                path.as_posix(),
+                mode="w",
+                shape=(self.n_frames,) + shape,
+                chunks=(1,) + shape,
+                dtype=dtype,
+                **kwargs,
+            )
+        if not create:
+            return memmap(path.as_posix(), mode="r+")
+        path.parent.mkdir(exist_ok=True)
+        return memmap(
+            path.as_posix(),
+            shape=(self.n_frames,) + shape,
+            dtype=dtype,
+            bigtiff=True,
+        )
+
+    def mark_done(self, t):
+        """
+        Records frame t as written, once all its outputs are on disk
+        """
+        for stack in self.stacks:
+            stack.flush()
+        self.done.add(t)
+        state = dict(self.state(), frames=sorted(self.done))
+        tmp_file = self.progress_file.with_name(self.progress_file.name + ".tmp")
+        tmp_file.write_text(json.dumps(state))
+        os.replace(tmp_file, self.progress_file)
+
+    def close(self):
+        """
+        :return: The on-disk stacks in output order, None for outputs that
+            are not persisted
+        """
+        for stack in self.stacks:
+            stack.flush()
+        return tuple(stack.array for stack in self.stacks)
+
+
+def frame_fingerprint(image, segment, params):
+    """
+    Hash of the shape, dtype and content of image and of the parameters it
+    is segmented with, the content is read one frame at a time
+    """
+    digest = hashlib.sha1()
+    digest.update(_params_hash(segment, params).encode())
+    digest.update(json.dumps([list(image.shape), str(image.dtype)]).encode())
+    for frame in image:
+        digest.update(np.ascontiguousarray(frame).data)
+    return digest.hexdigest()
+
+
+def _describe(value):
+
+    logdir = getattr(value, "logdir", None)
+    if logdir is not None:
+        # models are identified by their folder, their weights are not hashed
+        return f"{type(value).__name__}:{Path(logdir).as_posix()}"
+    return repr(value)
+
+
+def _params_hash(segment, params):
+
+    description = {name: _describe(value) for name, value in params.items()}
+    description["segment"] = segment.__name__
+    return hashlib.sha1(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+
+class _FrameStack:
+    def __init__(self, writer, output):
+
+        self.writer = writer
+        self.output = output
+        self._array = None
+
+    @property
+    def array(self):
+
+        if self._array is None:
+            self._array = self.writer.open(self.output)
+        return self._array
+
+    def __setitem__(self, t, x):
+
+        x = np.asarray(x)
+        dtype = np.dtype(self.writer.dtypes.get(self.output) or x.dtype)
+        if dtype == bool:
+            dtype = np.dtype(np.uint8)
+        if self._array is None:
+            self._array = self.writer.open(self.output, x.shape, dtype)
+        if self._array.shape[1:] != x.shape:
+            raise ValueError(
+                f"Frame {t} of {self.output} has shape {x.shape}, "
+                f"the stack on disk {self._array.shape[1:]}"
+            )
+        self._array[t] = x.astype(dtype, copy=False)
+
+    def flush(self):
+
+        if isinstance(self._array, np.memmap):
+            self._array.flush()
+
+
+class _NullStack:
+
+    array = None
+
+    def __setitem__(self, t, x):
+
+        pass
+
+    def flush(self):
+
+        pass
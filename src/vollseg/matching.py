@@ -281,6 +281,32 @@ def matching_dataset_lazy(
     parallel=False,
 ):
 
+    single_thresh = False
+    if np.isscalar(thresh):
+        single_thresh = True
+        thresh = (thresh,)
+
+    tqdm_kwargs = {}
+    tqdm_kwargs["disable"] = not bool(show_progress)
+    if int(show_progress) > 1:
+        tqdm_kwargs["total"] = int(show_progress)
+
+    # compute matching stats for every pair of label images
+    stats_all = tuple(
+        matching(y_t, y_p, thresh=thresh, criterion=criterion, report_matches=False)
+        for y_t, y_p in tqdm(y_gen, **tqdm_kwargs)
+    )
+
+    accumulate = accumulate_matching(
+        stats_all, thresh, criterion=criterion, by_image=by_image
+    )
+    return accumulate[0] if single_thresh else accumulate
+
+
+def accumulate_matching(stats_all, thresh, criterion="iou", by_image=False):
+    """dataset matching metrics from the per image results of `matching` for
+    a tuple of thresholds, see `matching_dataset`"""
+
     expected_keys = {
         "fp",
         "tp",
@@ -298,22 +324,6 @@ def matching_dataset_lazy(
         "panoptic_quality",
     }
 
-    single_thresh = False
-    if np.isscalar(thresh):
-        single_thresh = True
-        thresh = (thresh,)
-
-    tqdm_kwargs = {}
-    tqdm_kwargs["disable"] = not bool(show_progress)
-    if int(show_progress) > 1:
-        tqdm_kwargs["total"] = int(show_progress)
-
-    # compute matching stats for every pair of label images
-    stats_all = tuple(
-        matching(y_t, y_p, thresh=thresh, criterion=criterion, report_matches=False)
-        for y_t, y_p in tqdm(y_gen, **tqdm_kwargs)
-    )
-
     # accumulate results over all images for each threshold separately
     n_images, n_threshs = len(stats_all), len(thresh)
     accumulate = [{} for _ in range(n_threshs)]
@@ -365,10 +375,9 @@ def matching_dataset_lazy(
                 panoptic_quality=panoptic_quality,
             )
 
-    accumulate = tuple(
+    return tuple(
         namedtuple("DatasetMatching", acc.keys())(*acc.values()) for acc in accumulate
     )
-    return accumulate[0] if single_thresh else accumulate
 
 
 # copied from scikit-image master for now (remove when part of a release)
@@ -1,7 +1,6 @@
 from skimage import measure
 import numpy as np
 from skimage.util import map_array
-import vollseg.utils
 
 
 class NMSLabel:
@@ -10,29 +9,39 @@ class NMSLabel:
         self.nms_thresh = nms_thresh
         self.z_thresh = z_thresh
 
-    def supresslabels(self):
+    def supresslabels(self, indexed=True):
 
         print("Supressing spurious labels, this can take some time")
         properties = measure.regionprops(self.image)
         Bbox = [prop.bbox for prop in properties]
         Labels = [prop.label for prop in properties]
         self.supresslabel = {}
-        while len(Labels) > 0:
-            last = len(Labels) - 1
-            i = Labels[last]
-            suppress = [last]
-            for pos in range(0, last):
-                # grab the current index
-                j = Labels[pos]
-                self.iou(Bbox[last], Bbox[pos], i, j)
-
-            Labels = np.delete(Labels, suppress)
-
-        for (k, v) in self.supresslabel.items():
-            pixel_condition = self.image == k
-            pixel_replace_condition = v
-            self.image = vollseg.utils.image_conditionals(
-                self.image, pixel_condition, pixel_replace_condition
+        if indexed and self.nms_thresh > 0 and self.image.ndim in (2, 3):
+            self.indexed_iou(np.asarray(Bbox), np.asarray(Labels))
+        else:
+            while len(Labels) > 0:
+                last = len(Labels) - 1
+                i = Labels[last]
+                suppress = [last]
+                for pos in range(0, last):
+                    # grab the current index
+                    j = Labels[pos]
+                    self.iou(Bbox[last], Bbox[pos], i, j)
+
+                Labels = np.delete(Labels, suppress)
+
+        # The replacements chain in insertion order, compose them from the
+        # back so that a single relabel gives the same result
+        finallabel = {}
+        for (k, v) in reversed(list(self.supresslabel.items())):
+            finallabel[k] = finallabel.get(v, v)
+        if len(finallabel) > 0:
+            originallabels = [prop.label for prop in properties]
+            self.image = map_array(
+                self.image,
+                np.asarray(originallabels),
+                np.asarray([finallabel.get(k, k) for k in originallabels]),
+                out=np.empty_like(self.image),
             )
 
         return self.image
@@ -70,6 +79,82 @@ class NMSLabel:
                 self.originallabels.append(label)
                 self.newlabels.append(label)
 
+    def overlapping_pairs(self, Bbox, axes):
+
+        # Sorted sweep along the first axis, closed intervals as in iou
+        starts = Bbox[:, axes[0]]
+        order = np.argsort(starts, kind="stable")
+        sorted_starts = starts[order]
+        stops = np.searchsorted(
+            sorted_starts, Bbox[order, axes[0] + Bbox.shape[1] // 2], side="right"
+        )
+        counts = np.maximum(stops - np.arange(1, len(order) + 1), 0)
+        first = np.repeat(np.arange(len(order)), counts)
+        offsets = np.arange(counts.sum()) - np.repeat(
+            np.cumsum(counts) - counts, counts
+        )
+        second = first + 1 + offsets
+        first, second = order[first], order[second]
+        ndim = Bbox.shape[1] // 2
+        keep = np.ones(len(first), dtype=bool)
+        for axis in axes[1:]:
+            keep &= np.minimum(Bbox[first, axis + ndim], Bbox[second, axis + ndim]) >= (
+                np.maximum(Bbox[first, axis], Bbox[second, axis])
+            )
+        first, second = first[keep], second[keep]
+
+        return np.maximum(first, second), np.minimum(first, second)
+
+    def indexed_iou(self, Bbox, Labels):
+
+        ndim = len(self.image.shape)
+        if len(Labels) < 2:
+            return
+        if ndim == 2:
+            axes = (0, 1)
+        else:
+            axes = (1, 2)
+        last, pos = self.overlapping_pairs(Bbox, axes)
+        # Same order as the exhaustive loop: last descending, pos ascending
+        order = np.lexsort((pos, -last))
+        last, pos = last[order], pos[order]
+        boxA, boxB = Bbox[last], Bbox[pos]
+
+        contains_ab = np.ones(len(last), dtype=bool)
+        contains_ba = np.ones(len(last), dtype=bool)
+        for axis in axes:
+            contains_ab &= (boxA[:, axis] <= boxB[:, axis]) & (
+                boxA[:, axis + ndim] >= boxB[:, axis + ndim]
+            )
+            contains_ba &= (boxB[:, axis] <= boxA[:, axis]) & (
+                boxB[:, axis + ndim] >= boxA[:, axis + ndim]
+            )
+        interArea = np.ones(len(last), dtype=np.int64)
+        boxAArea = np.ones(len(last), dtype=np.int64)
+        boxBArea = np.ones(len(last), dtype=np.int64)
+        for axis in range(ndim):
+            low = np.maximum(boxA[:, axis], boxB[:, axis])
+            high = np.minimum(boxA[:, axis + ndim], boxB[:, axis + ndim])
+            interArea *= np.maximum(0, high - low + 1)
+            boxAArea *= boxA[:, axis + ndim] - boxA[:, axis] + 1
+            boxBArea *= boxB[:, axis + ndim] - boxB[:, axis] + 1
+        iou = interArea / (boxAArea + boxBArea - interArea).astype(np.float64)
+        overlap = iou >= self.nms_thresh
+
+        if ndim == 2:
+            first = contains_ab
+            second = contains_ba | overlap
+        else:
+            first = contains_ab
+            second = ~contains_ab & (contains_ba | overlap)
+
+        labelA, labelB = Labels[last], Labels[pos]
+        keys = np.stack([labelB, labelA], axis=1)
+        values = np.stack([labelA, labelB], axis=1)
+        assigned = np.stack([first, second], axis=1)
+        for k, v in zip(keys[assigned], values[assigned]):
+            self.supresslabel[k] = v
+
     def iou(self, boxA, boxB, labelA, labelB):
 
         ndim = len(self.image.shape)
@@ -1,3 +1,6 @@
+import numpy as np
+
+
 class SeedPool:
     def __init__(self, boxA, cordB):
 
@@ -28,3 +31,74 @@ class SeedPool:
             include = False
 
         return include
+
+
+def _inside_counts(lower, upper, points, chunk_size=2**22):
+
+    counts = np.zeros(len(lower), dtype=np.int64)
+    if len(lower) == 0 or len(points) == 0:
+        return counts
+    step = max(1, chunk_size // (len(points) * points.shape[1]))
+    for start in range(0, len(lower), step):
+        stop = start + step
+        inside = np.logical_and(
+            points[None, :, :] >= lower[start:stop, None, :],
+            points[None, :, :] <= upper[start:stop, None, :],
+        ).all(axis=-1)
+        counts[start:stop] = inside.sum(axis=1)
+    return counts
+
+
+def boxes_exclude_points(boxes, points, start_axis=0):
+    """Batched form of SeedPool.pooling and UnetStarMask.masking.
+
+    boxes is an (N, 2 * ndim) array of regionprops bboxes and points an
+    (M, ndim) array of centroids. Returns a boolean array of length N that is
+    True where none of the points fall inside the box along the axes from
+    start_axis on (start_axis=1 gives UnetStarMask.semi_masking).
+    """
+    if len(boxes) == 0 or len(points) == 0:
+        return np.ones(len(boxes), dtype=bool)
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(len(boxes), -1)
+    points = np.asarray(points, dtype=np.float64).reshape(len(points), -1)
+    ndim = points.shape[1]
+    counts = _inside_counts(
+        boxes[:, start_axis:ndim],
+        boxes[:, ndim + start_axis : 2 * ndim],
+        points[:, start_axis:],
+    )
+    return counts == 0
+
+
+def pool_seeds(boxes, box_coordinates, coordinates):
+    """Batched seed pooling over all (bbox, centroid) pairs.
+
+    A box contributes its own centroid from box_coordinates when neither the
+    seed coordinates nor any centroid already pooled from an earlier box lie
+    inside it, matching the sequential SeedPool loop used by the watershed
+    functions. Returns the pooled centroids in box order.
+    """
+    if len(boxes) == 0:
+        return []
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(len(boxes), -1)
+    box_coordinates = np.asarray(box_coordinates, dtype=np.float64).reshape(
+        len(boxes), -1
+    )
+    candidates = np.flatnonzero(boxes_exclude_points(boxes, coordinates))
+    if len(candidates) == 0:
+        return []
+    ndim = box_coordinates.shape[1]
+    lower = boxes[candidates, :ndim]
+    upper = boxes[candidates, ndim:]
+    pooled = box_coordinates[candidates]
+    # A candidate whose box holds no other candidate centroid is always
+    # pooled, only the remaining ones depend on the earlier decisions.
+    own = np.logical_and(pooled >= lower, pooled <= upper).all(axis=-1)
+    others = _inside_counts(lower, upper, pooled) - own
+    accepted = np.ones(len(candidates), dtype=bool)
+    for i in np.flatnonzero(others > 0):
+        earlier = pooled[:i][accepted[:i]]
+        accepted[i] = not np.any(
+            np.logical_and(earlier >= lower[i], earlier <= upper[i]).all(axis=-1)
+        )
+    return [tuple(coord) for coord in pooled[accepted]]
@@ -4,25 +4,25 @@ Created on Fri Sep 27 13:08:41 2019
 @author: vkapoor
 """
 
+from __future__ import annotations
 
 import math
 import os
+import threading
+from collections import deque
 from pathlib import Path
-import torch
-import napari
 import gc
 from skimage.transform import resize
 import numpy as np
-from numba import jit
 from scipy.optimize import linear_sum_assignment
 from scipy.ndimage import convolve, mean
-import cv2
+from scipy.sparse import csr_matrix, issparse
+from scipy.sparse.csgraph import connected_components, maximum_bipartite_matching
 from skimage.segmentation import clear_border
 from scipy.ndimage import gaussian_filter
 
 # import matplotlib.pyplot as plt
 import pandas as pd
-from cellpose import models
 from csbdeep.utils import normalize
 from concurrent.futures import ThreadPoolExecutor
 from scipy import spatial
@@ -30,12 +30,13 @@ from scipy.ndimage import (
     binary_dilation,
     binary_erosion,
     distance_transform_edt,
+    generate_binary_structure,
 )
 from scipy.ndimage.measurements import find_objects
 from scipy.ndimage.morphology import binary_fill_holes
 from skimage import measure, morphology
 from skimage.filters import threshold_multiotsu
-from skimage.measure import label, regionprops
+from skimage.measure import label
 from skimage.morphology import (
     dilation,
     remove_small_objects,
@@ -51,25 +52,35 @@ from skimage.segmentation import (
 from skimage.util import invert as invertimage
 from tifffile import imread, imwrite
 from tqdm import tqdm
-from typing import Union
-from .StarDist3D import StarDist3D
-from .UNET import UNET
-from .CARE import CARE
-from .MASKUNET import MASKUNET
-from vollseg.matching import matching
+from typing import TYPE_CHECKING, Union
 from vollseg.nmslabel import NMSLabel
-from vollseg.seedpool import SeedPool
+from vollseg.seedpool import SeedPool, boxes_exclude_points, pool_seeds
 from vollseg.unetstarmask import UnetStarMask
+from .framewriter import FrameWriter, frame_fingerprint
 from numba import njit
-from csbdeep.models import ProjectionCARE
 from skimage.filters import threshold_otsu
 
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+if TYPE_CHECKING:
+    from csbdeep.models import ProjectionCARE
+    from .StarDist3D import StarDist3D
+    from .UNET import UNET
+    from .CARE import CARE
+    from .MASKUNET import MASKUNET
 
 
 Boxname = "ImageIDBox"
 GLOBAL_THRESH = 1.0e-2
 GLOBAL_ERODE = 8
+# Label pairs above which overlap and IoU matrices are built sparse
+GLOBAL_DENSE_OVERLAP = 2**24
+
+
+def _is_projection(model):
+
+    # csbdeep.models imports TensorFlow, a model is loaded by the time this runs
+    from csbdeep.models import ProjectionCARE
+
+    return isinstance(model, ProjectionCARE)
 
 
 class SegCorrect:
@@ -80,6 +91,7 @@ class SegCorrect:
         self.acceptable_formats = [".tif", ".TIFF", ".TIF", ".png"]
 
     def showNapari(self):
+        import napari
         from qtpy.QtWidgets import QComboBox, QPushButton
 
         self.viewer = napari.Viewer()
@@ -170,6 +182,7 @@ class ProjSegCreate:
         self.acceptable_formats = [".tif", ".TIFF", ".TIF", ".png"]
 
     def showNapari(self):
+        import napari
         from qtpy.QtWidgets import QComboBox, QPushButton
 
         self.viewer = napari.Viewer()
@@ -323,151 +336,130 @@ def fill_label_holes(lbl_img, **kwargs):
     return lbl_img_filled
 
 
-def dilate_label_holes(lbl_img, iterations):
-    lbl_img_filled = np.zeros_like(lbl_img)
-    for lb in range(np.min(lbl_img), np.max(lbl_img) + 1):
-        mask = lbl_img == lb
-        mask_filled = binary_dilation(mask, iterations=iterations)
-        lbl_img_filled[mask_filled] = lb
-    return lbl_img_filled
+def _label_morphology(
+    lbl_img, operation, iterations, per_slice=False, dtype=None, n_workers=None
+):
+    """Apply a binary morphology operation to every label on its own crop.
 
+    Each label is processed on its find_objects crop, grown by the reach of
+    the operation, on a pool of n_workers threads. The results are written
+    in place into one output array in increasing label order, so where
+    dilated labels overlap the higher label wins. With per_slice the
+    operation acts on every z slice of a 3D image separately.
+    """
+    structure = generate_binary_structure(lbl_img.ndim, 1)
+    # erosion never leaves the bounding box, dilation grows by one pixel
+    # per iteration along every axis it acts on
+    reach = [iterations if operation is binary_dilation else 0] * lbl_img.ndim
+    if per_slice and lbl_img.ndim == 3:
+        structure[0] = False
+        structure[2] = False
+        reach[0] = 0
+    out = np.zeros(lbl_img.shape, dtype=lbl_img.dtype if dtype is None else dtype)
+
+    def _process(label_id, sl):
+        grown = tuple(
+            slice(max(s.start - r, 0), min(s.stop + r, size))
+            for s, r, size in zip(sl, reach, lbl_img.shape)
+        )
+        mask = operation(
+            lbl_img[grown] == label_id, structure=structure, iterations=iterations
+        )
+        return grown, mask
 
-def erode_labels(lbl_img, iterations=1):
-    lbl_img_filled = np.zeros_like(lbl_img)
-    for lb in range(np.min(lbl_img), np.max(lbl_img) + 1):
-        mask = lbl_img == lb
-        mask_filled = binary_erosion(mask, iterations=iterations)
-        lbl_img_filled[mask_filled] = lb
-    return lbl_img_filled
+    objects = [
+        (label_id, sl)
+        for label_id, sl in enumerate(find_objects(lbl_img), 1)
+        if sl is not None
+    ]
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        results = executor.map(lambda obj: _process(*obj), objects)
+        for (label_id, _), (grown, mask) in zip(objects, results):
+            out[grown][mask] = label_id
+    return out
 
 
-def erode_label_regions(segmentation, erosion_iterations=1):
-    regions = regionprops(segmentation)
-    erode = np.zeros(segmentation.shape)
-
-    def erode_mask(segmentation_labels, label_id, erosion_iterations):
-        only_current_label_id = np.where(segmentation_labels == label_id, 1, 0)
-        eroded = binary_erosion(only_current_label_id, iterations=erosion_iterations)
-        relabeled_eroded = np.where(eroded == 1, label_id, 0)
-        return relabeled_eroded
-
-    def process_region_2d(label_id):
-        return erode_mask(segmentation, label_id, erosion_iterations)
-
-    def process_region_3d(label_id, z):
-        return erode_mask(segmentation[z, :, :], label_id, erosion_iterations)
-
-    # For 3D segmentation, we parallelize over both regions and slices (z-axis)
-    if segmentation.ndim == 3:
-        with ThreadPoolExecutor() as executor:
-            futures = []
-            for i in range(len(regions)):
-                label_id = regions[i].label
-                for z in range(segmentation.shape[0]):
-                    futures.append(executor.submit(process_region_3d, label_id, z))
-
-            # Aggregate results
-            for future in futures:
-                result, z = (
-                    future.result(),
-                    futures.index(future) % segmentation.shape[0],
-                )
-                erode[z, :, :] += result
+def dilate_label_holes(lbl_img, iterations, n_workers=None):
+    return _label_morphology(lbl_img, binary_dilation, iterations, n_workers=n_workers)
 
-    # For 2D segmentation, we parallelize only over regions
-    else:
-        with ThreadPoolExecutor() as executor:
-            futures = [
-                executor.submit(process_region_2d, regions[i].label)
-                for i in range(len(regions))
-            ]
-
-            # Aggregate results
-            for future in futures:
-                erode += future.result()
-
-    return erode
-
-
-def dilate_label_regions(segmentation, dilation_iterations=1):
-    regions = regionprops(segmentation)
-    erode = np.zeros(segmentation.shape)
-
-    def dilate_mask(segmentation_labels, label_id, dilation_iterations):
-        only_current_label_id = np.where(segmentation_labels == label_id, 1, 0)
-        dilated = binary_dilation(only_current_label_id, iterations=dilation_iterations)
-        relabeled_dilated = np.where(dilated == 1, label_id, 0)
-        return relabeled_dilated
-
-    def process_region_2d(label_id):
-        return dilate_mask(segmentation, label_id, dilation_iterations)
-
-    def process_region_3d(label_id, z):
-        return dilate_mask(segmentation[z, :, :], label_id, dilation_iterations)
-
-    # For 3D segmentation, parallelize over both regions and slices (z-axis)
-    if segmentation.ndim == 3:
-        with ThreadPoolExecutor() as executor:
-            futures = []
-            for i in range(len(regions)):
-                label_id = regions[i].label
-                for z in range(segmentation.shape[0]):
-                    futures.append(executor.submit(process_region_3d, label_id, z))
-
-            # Aggregate results
-            for future in futures:
-                result, z = (
-                    future.result(),
-                    futures.index(future) % segmentation.shape[0],
-                )
-                erode[z, :, :] += result
 
-    # For 2D segmentation, parallelize only over regions
-    else:
-        with ThreadPoolExecutor() as executor:
-            futures = [
-                executor.submit(process_region_2d, regions[i].label)
-                for i in range(len(regions))
-            ]
+def erode_labels(lbl_img, iterations=1, n_workers=None):
+    return _label_morphology(lbl_img, binary_erosion, iterations, n_workers=n_workers)
+
+
+def erode_label_regions(segmentation, erosion_iterations=1, n_workers=None):
+    # 3D segmentations are eroded slice by slice
+    return _label_morphology(
+        segmentation,
+        binary_erosion,
+        erosion_iterations,
+        per_slice=True,
+        dtype=np.uint16,
+        n_workers=n_workers,
+    )
 
-            # Aggregate results
-            for future in futures:
-                erode += future.result()
 
-    return erode
+def dilate_label_regions(segmentation, dilation_iterations=1, n_workers=None):
+    # 3D segmentations are dilated slice by slice
+    return _label_morphology(
+        segmentation,
+        binary_dilation,
+        dilation_iterations,
+        per_slice=True,
+        dtype=np.uint16,
+        n_workers=n_workers,
+    )
+
+
+def _match_slice_pair(y_prev, y, nms_thresh):
 
+    # one sparse IoU table per slice pair, assignment only over its entries
+    iou = _intersection_over_union(y_prev, y, sparse=True)
+    present = np.flatnonzero(iou.getnnz(axis=0))
+    true_ind, pred_ind, matched_iou = _sparse_assignment(iou[1:, 1:], nms_thresh)
+    match_ok = matched_iou >= nms_thresh
+    return true_ind[match_ok] + 1, pred_ind[match_ok] + 1, present[present > 0]
 
-def match_labels(ys: np.ndarray, nms_thresh=0.5):
 
+def match_labels(ys: np.ndarray, nms_thresh=0.5, n_workers=1):
+    """Link the 2D labels of consecutive slices into 3D labels.
+
+    A label of slice i + 1 takes over the id of the slice i label it is
+    matched to (IoU >= nms_thresh), unmatched labels get new ids. The
+    matching only depends on the regions, not on their ids, so the slice
+    pairs are matched on the input labels, with n_workers threads, and
+    the ids are reconciled afterwards with one lookup table per slice.
+    """
     if nms_thresh is None:
         nms_thresh = 0.3
     ys_grouped = np.empty_like(ys, dtype=np.uint16)
-
-    def _match_single(y_prev, y, next_id):
-        y = y.astype(np.uint16, copy=False)
-        res = matching(
-            y_prev,
-            y,
-            report_matches=True,
-            thresh=nms_thresh,
-            criterion="iou",
+    if len(ys) == 0:
+        return ys_grouped
+
+    def _match_pair(i):
+        return _match_slice_pair(
+            ys[i].astype(np.uint16, copy=False),
+            ys[i + 1].astype(np.uint16, copy=False),
+            nms_thresh,
         )
-        # relabel dict (for matching labels) that maps label ids from y -> y_prev
-        relabel = dict(reversed(res.matched_pairs[i]) for i in res.matched_tps)
-        y_grouped = np.zeros_like(y)
-        for r in regionprops(y):
-            m = y[r.slice] == r.label
-            if r.label in relabel:
-                y_grouped[r.slice][m] = relabel[r.label]
-            else:
-                y_grouped[r.slice][m] = next_id
-                next_id += 1
-        return y_grouped, next_id
+
+    if n_workers > 1:
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            matches = list(executor.map(_match_pair, range(len(ys) - 1)))
+    else:
+        matches = map(_match_pair, range(len(ys) - 1))
 
     ys_grouped[0] = ys[0]
-    next_id = ys_grouped[0].max() + 1
-    for i in range(len(ys) - 1):
-        ys_grouped[i + 1], next_id = _match_single(ys_grouped[i], ys[i + 1], next_id)
+    next_id = int(ys_grouped[0].max()) + 1
+    relabel_prev = np.arange(next_id, dtype=np.int64)
+    for i, (matched_prev, matched, present) in enumerate(matches):
+        relabel = np.zeros(int(ys[i + 1].max()) + 1, dtype=np.int64)
+        relabel[matched] = relabel_prev[matched_prev]
+        unmatched = present[~np.isin(present, matched)]
+        relabel[unmatched] = next_id + np.arange(len(unmatched))
+        next_id += len(unmatched)
+        ys_grouped[i + 1] = relabel[ys[i + 1]]
+        relabel_prev = relabel
     return ys_grouped
 
 
@@ -515,41 +507,84 @@ def CCLabels(fname, max_size=15000):
     return AugmentedLabel
 
 
-def CreateTrackMate_CSV(Label, Name, savedir):
-
-    TimeList = []
-
-    XList = []
-    YList = []
-    TrackIDList = []
-    QualityList = []
+def _frame_label_stats(frame):
+    """Pixel count, coordinate sums and bounding box of every label of a 2D
+    frame, from one stable sort of its foreground pixels."""
+    frame = np.asarray(frame)
+    flat = frame.ravel()
+    pixels = np.flatnonzero(flat)
+    if len(pixels) == 0:
+        return None
+    labels = flat[pixels]
+    order = np.argsort(labels, kind="stable")
+    labels = labels[order]
+    y, x = np.divmod(pixels[order], frame.shape[1])
+    starts = np.flatnonzero(np.r_[True, labels[1:] != labels[:-1]])
+    counts = np.diff(np.r_[starts, len(labels)])
+    return (
+        labels[starts].astype(np.int64),
+        counts,
+        np.add.reduceat(y, starts),
+        np.add.reduceat(x, starts),
+        np.minimum.reduceat(y, starts),
+        np.minimum.reduceat(x, starts),
+        np.maximum.reduceat(y, starts),
+        np.maximum.reduceat(x, starts),
+    )
 
-    CurrentSegimage = Label.astype("uint16")
-    properties = measure.regionprops(CurrentSegimage)
-    for prop in properties:
 
-        T = prop.centroid[0]
-        Y = prop.centroid[1]
-        X = prop.centroid[2]
-        regionlabel = prop.label
-        sizeZ = abs(prop.bbox[0] - prop.bbox[3])
-        sizeY = abs(prop.bbox[1] - prop.bbox[4])
-        sizeX = abs(prop.bbox[2] - prop.bbox[5])
-        volume = sizeZ * sizeX * sizeY
-        radius = math.pow(3 * volume / (4 * math.pi), 1.0 / 3.0)
-        TimeList.append(int(T))
-        XList.append(int(X))
-        YList.append(int(Y))
-        TrackIDList.append(regionlabel)
-        QualityList.append(radius)
+def CreateTrackMate_CSV(Label, Name, savedir, file_format="csv"):
+    """
+    Writes one TrackMate row per label of a TYX label stack: centroid
+    position and frame, and the radius of the sphere of its bounding box
+    volume as quality. Frames are read one at a time, so Label can be a
+    memmap or any lazily indexed array, and per label sums are accumulated
+    instead of keeping the stack in memory.
+    """
+    size = 0
+    count = np.zeros(size, dtype=np.int64)
+    sums = np.zeros((3, size))
+    low = np.zeros((3, size), dtype=np.int64)
+    high = np.zeros((3, size), dtype=np.int64)
+
+    for t in range(len(Label)):
+        stats = _frame_label_stats(Label[t])
+        if stats is None:
+            continue
+        ids, counts, sum_y, sum_x, min_y, min_x, max_y, max_x = stats
+        if ids[-1] >= size:
+            grow = ids[-1] + 1 - size
+            count = np.concatenate([count, np.zeros(grow, dtype=np.int64)])
+            sums = np.concatenate([sums, np.zeros((3, grow))], axis=1)
+            low = np.concatenate(
+                [low, np.full((3, grow), np.iinfo(np.int64).max)], axis=1
+            )
+            high = np.concatenate([high, np.full((3, grow), -1)], axis=1)
+            size = ids[-1] + 1
+        count[ids] += counts
+        sums[:, ids] += [t * counts, sum_y, sum_x]
+        low[:, ids] = np.minimum(low[:, ids], [np.full_like(ids, t), min_y, min_x])
+        high[:, ids] = np.maximum(high[:, ids], [np.full_like(ids, t), max_y, max_x])
+
+    labels = np.flatnonzero(count)
+    T, Y, X = sums[:, labels] / count[labels]
+    volume = np.prod(high[:, labels] - low[:, labels] + 1, axis=0)
+    radius = np.power(3 * volume / (4 * math.pi), 1.0 / 3.0)
 
     df = pd.DataFrame(
-        list(zip(XList, YList, TimeList, TrackIDList, QualityList)),
-        index=None,
-        columns=["POSITION_X", "POSITION_Y", "FRAME", "TRACK_ID", "QUALITY"],
+        {
+            "POSITION_X": X.astype(int),
+            "POSITION_Y": Y.astype(int),
+            "FRAME": T.astype(int),
+            "TRACK_ID": labels,
+            "QUALITY": radius,
+        }
     )
 
-    df.to_csv(savedir + "/" + "TrackMate_csv" + Name + ".csv", index=False)
+    if file_format == "parquet":
+        df.to_parquet(savedir + "/" + "TrackMate_csv" + Name + ".parquet", index=False)
+    else:
+        df.to_csv(savedir + "/" + "TrackMate_csv" + Name + ".csv", index=False)
 
 
 def SmartSkel(smart_seedsLabels, ProbImage, RGB=False):
@@ -923,7 +958,7 @@ def VollSeg_unet(
     if roi_model is not None:
 
         if noise_model is not None:
-            if isinstance(noise_model, ProjectionCARE):
+            if _is_projection(noise_model):
                 n_tiles = (1, n_tiles[-2], n_tiles[-1])
             image = noise_model.predict(image.astype("float32"), axes, n_tiles=n_tiles)
 
@@ -938,7 +973,7 @@ def VollSeg_unet(
             else:
                 tiles = n_tiles
             maximage = np.amax(image, axis=0)
-            if isinstance(roi_model, ProjectionCARE):
+            if _is_projection(roi_model):
                 n_tiles = (1, n_tiles[-2], n_tiles[-1])
             roi_Segmented = roi_model.predict(
                 maximage.astype("float32"), "YX", n_tiles=tiles
@@ -962,7 +997,7 @@ def VollSeg_unet(
             s_Binary = fill_label_holes(s_Binary)
 
         elif model_dim == len(image.shape):
-            if isinstance(roi_model, ProjectionCARE):
+            if _is_projection(roi_model):
                 n_tiles = (1, n_tiles[-2], n_tiles[-1])
             roi_Segmented = roi_model.predict(
                 image.astype("float32"), axes, n_tiles=n_tiles
@@ -1001,7 +1036,7 @@ def VollSeg_unet(
                 n_tiles = (n_tiles[0], n_tiles[1], 1)
 
         if noise_model is not None:
-            if isinstance(noise_model, ProjectionCARE):
+            if _is_projection(noise_model):
                 n_tiles = (1, n_tiles[-2], n_tiles[-1])
             image = noise_model.predict(image.astype("float32"), axes, n_tiles=n_tiles)
             if roi_model is not None:
@@ -1083,6 +1118,105 @@ def VollSeg_unet(
         return Finalimage.astype("uint16"), skeleton, image, s_Binary
 
 
+class _SerialModel:
+    """
+    Proxy for a model shared by the frames of a time-lapse, lets one frame
+    at a time into its network.
+    """
+
+    def __init__(self, model, lock):
+
+        self.model = model
+        self.lock = lock
+
+    @property
+    def __class__(self):
+
+        # keep isinstance checks of the pipeline working
+        return self.model.__class__
+
+    def __getattr__(self, name):
+
+        return getattr(self.model, name)
+
+    def predict(self, *args, **kwargs):
+
+        with self.lock:
+            return self.model.predict(*args, **kwargs)
+
+    def predict_vollseg(self, *args, **kwargs):
+
+        with self.lock:
+            return self.model.predict_vollseg(*args, **kwargs)
+
+
+def _stack_output(stack, t, n_frames, x, given=False):
+
+    if stack is None:
+        if isinstance(x, np.ndarray):
+            stack = np.zeros((n_frames,) + x.shape, dtype=x.dtype)
+        else:
+            stack = [None] * n_frames
+    elif isinstance(stack, np.ndarray) and not given:
+        if not isinstance(x, np.ndarray) or x.shape != stack.shape[1:]:
+            # ragged output, the frames stored so far are kept as a list
+            stack = list(stack[:t]) + [None] * (n_frames - t)
+        elif not np.can_cast(x.dtype, stack.dtype):
+            stack = stack.astype(np.result_type(stack.dtype, x.dtype))
+    stack[t] = x
+    return stack
+
+
+def _time_lapse(
+    frame_fn, n_frames, models=(), n_workers=1, out=None, skip=(), callback=None
+):
+    """
+    Runs frame_fn(t, *models) for every time point and stacks each of its
+    outputs along a new leading axis, in place of tuple(zip(*frames)).
+
+    Frames run one after another unless n_workers > 1 is asked for, then up
+    to n_workers frames are in flight on a thread pool. The models are
+    shared between them with their predict calls serialised, so the network
+    runs on one frame while the others are post-processed. Every finished
+    frame is written into out[k] (any array supporting out[k][t] = x, e.g. a
+    memmap) or into an array allocated from the first frame, and released.
+    Outputs that are not arrays of a fixed shape are collected in lists.
+    Frames in skip are not run, callback(t) is called once frame t is stored.
+    """
+    out = [] if out is None else list(out)
+    stacks = []
+
+    def store(t, frame):
+
+        if not stacks:
+            stacks.extend(out[: len(frame)] + [None] * (len(frame) - len(out)))
+        for k, x in enumerate(frame):
+            given = k < len(out) and out[k] is not None
+            stacks[k] = _stack_output(stacks[k], t, n_frames, x, given)
+        if callback is not None:
+            callback(t)
+
+    frames = [t for t in range(n_frames) if t not in skip]
+    if n_workers <= 1:
+        for t in tqdm(frames):
+            store(t, frame_fn(t, *models))
+        return tuple(stacks)
+
+    lock = threading.RLock()
+    models = [None if m is None else _SerialModel(m, lock) for m in models]
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=n_workers) as executor, tqdm(
+        total=len(frames)
+    ) as progress:
+        for t in frames:
+            pending.append((t, executor.submit(frame_fn, t, *models)))
+            while len(pending) > n_workers or (t == frames[-1] and pending):
+                done, future = pending.popleft()
+                store(done, future.result())
+                progress.update()
+    return tuple(stacks)
+
+
 def _cellpose_time_block(
     image_membrane,
     diameter_cellpose,
@@ -1095,45 +1229,41 @@ def _cellpose_time_block(
     do_3D,
 ):
 
+    from cellpose import models
+
     if cellpose_model_path is not None:
 
         cellpose_model = models.CellposeModel(
             gpu=gpu, pretrained_model=cellpose_model_path
         )
         if anisotropy is not None:
-            cellres = tuple(
-                zip(
-                    *tuple(
-                        cellpose_model.eval(
-                            _x,
-                            diameter=diameter_cellpose,
-                            flow_threshold=flow_threshold,
-                            cellprob_threshold=cellprob_threshold,
-                            stitch_threshold=stitch_threshold,
-                            anisotropy=anisotropy,
-                            tile=True,
-                            do_3D=do_3D,
-                        )
-                        for _x in tqdm(image_membrane)
-                    )
-                )
+            cellres = _time_lapse(
+                lambda t: cellpose_model.eval(
+                    image_membrane[t],
+                    diameter=diameter_cellpose,
+                    flow_threshold=flow_threshold,
+                    cellprob_threshold=cellprob_threshold,
+                    stitch_threshold=stitch_threshold,
+                    anisotropy=anisotropy,
+                    tile=True,
+                    do_3D=do_3D,
+                ),
+                len(image_membrane),
+                n_workers=1,
             )
         else:
-            cellres = tuple(
-                zip(
-                    *tuple(
-                        cellpose_model.eval(
-                            _x,
-                            diameter=diameter_cellpose,
-                            flow_threshold=flow_threshold,
-                            cellprob_threshold=cellprob_threshold,
-                            stitch_threshold=stitch_threshold,
-                            tile=True,
-                            do_3D=do_3D,
-                        )
-                        for _x in tqdm(image_membrane)
-                    )
-                )
+            cellres = _time_lapse(
+                lambda t: cellpose_model.eval(
+                    image_membrane[t],
+                    diameter=diameter_cellpose,
+                    flow_threshold=flow_threshold,
+                    cellprob_threshold=cellprob_threshold,
+                    stitch_threshold=stitch_threshold,
+                    tile=True,
+                    do_3D=do_3D,
+                ),
+                len(image_membrane),
+                n_workers=1,
             )
 
     return cellres
@@ -1160,6 +1290,7 @@ def _super_star_time_block(
     lower_perc,
     upper_perc,
     slice_merge,
+    n_workers=1,
 ):
 
     if star_model_nuclei is not None:
@@ -1169,34 +1300,37 @@ def _super_star_time_block(
             prob_thresh_nuclei = star_model_nuclei.thresholds.prob
             nms_thresh_nuclei = star_model_nuclei.thresholds.nms
 
-        res = tuple(
-            zip(
-                *tuple(
-                    SuperVollSeg(
-                        image_nuclei[i, ...],
-                        unet_model_nuclei,
-                        star_model_nuclei,
-                        axes=axes,
-                        noise_model=noise_model,
-                        roi_model_nuclei=roi_model_nuclei,
-                        prob_thresh_nuclei=prob_thresh_nuclei,
-                        nms_thresh_nuclei=nms_thresh_nuclei,
-                        min_size_mask=min_size_mask,
-                        min_size=min_size,
-                        max_size=max_size,
-                        n_tiles=n_tiles,
-                        UseProbability=UseProbability,
-                        ExpandLabels=ExpandLabels,
-                        dounet=dounet,
-                        seedpool=seedpool,
-                        donormalize=donormalize,
-                        lower_perc=lower_perc,
-                        upper_perc=upper_perc,
-                        slice_merge=slice_merge,
-                    )
-                    for i in tqdm(range(image_nuclei.shape[0]))
-                )
+        def _frame(
+            i, unet_model_nuclei, star_model_nuclei, noise_model, roi_model_nuclei
+        ):
+            return SuperVollSeg(
+                image_nuclei[i, ...],
+                unet_model_nuclei,
+                star_model_nuclei,
+                axes=axes,
+                noise_model=noise_model,
+                roi_model_nuclei=roi_model_nuclei,
+                prob_thresh_nuclei=prob_thresh_nuclei,
+                nms_thresh_nuclei=nms_thresh_nuclei,
+                min_size_mask=min_size_mask,
+                min_size=min_size,
+                max_size=max_size,
+                n_tiles=n_tiles,
+                UseProbability=UseProbability,
+                ExpandLabels=ExpandLabels,
+                dounet=dounet,
+                seedpool=seedpool,
+                donormalize=donormalize,
+                lower_perc=lower_perc,
+                upper_perc=upper_perc,
+                slice_merge=slice_merge,
             )
+
+        res = _time_lapse(
+            _frame,
+            image_nuclei.shape[0],
+            (unet_model_nuclei, star_model_nuclei, noise_model, roi_model_nuclei),
+            n_workers,
         )
 
     return res
@@ -1275,16 +1409,10 @@ def _cellpose_star_time_block(
 
 def collate_fn(data):
 
-    slices = []
-    input_tensor = []
-    for x, y in data:
-
-        if len(input_tensor) == 0:
-            input_tensor = torch.stack([x])
-        else:
-            input_tensor = torch.stack([input_tensor, x])
+    import torch
 
-        slices.append(y)
+    input_tensor = torch.stack([x for x, _ in data])
+    slices = [y for _, y in data]
 
     return input_tensor, slices
 
@@ -1321,6 +1449,8 @@ def _cellpose_star_block(
     do_3D,
 ):
 
+    from cellpose import models
+
     cellres = None
 
     res = SuperVollSeg(
@@ -1389,6 +1519,8 @@ def _cellpose_voll(
     channels=None,
 ):
 
+    from cellpose import models
+
     cellpose_model = models.CellposeModel(gpu=gpu, pretrained_model=cellpose_model_path)
     if anisotropy is not None:
         cellres = cellpose_model.eval(
@@ -1430,43 +1562,39 @@ def _cellpose_voll_time(
     channels=None,
 ):
 
+    from cellpose import models
+
     cellpose_model = models.CellposeModel(gpu=gpu, pretrained_model=cellpose_model_path)
     if anisotropy is not None:
-        cellres = tuple(
-            zip(
-                *tuple(
-                    cellpose_model.eval(
-                        _x,
-                        diameter=diameter_cellpose,
-                        channels=channels,
-                        flow_threshold=flow_threshold,
-                        cellprob_threshold=cellprob_threshold,
-                        stitch_threshold=stitch_threshold,
-                        anisotropy=anisotropy,
-                        tile=True,
-                        do_3D=do_3D,
-                    )
-                    for _x in tqdm(image)
-                )
-            )
+        cellres = _time_lapse(
+            lambda t: cellpose_model.eval(
+                image[t],
+                diameter=diameter_cellpose,
+                channels=channels,
+                flow_threshold=flow_threshold,
+                cellprob_threshold=cellprob_threshold,
+                stitch_threshold=stitch_threshold,
+                anisotropy=anisotropy,
+                tile=True,
+                do_3D=do_3D,
+            ),
+            len(image),
+            n_workers=1,
         )
     else:
-        cellres = tuple(
-            zip(
-                *tuple(
-                    cellpose_model.eval(
-                        _x,
-                        diameter=diameter_cellpose,
-                        channels=channels,
-                        flow_threshold=flow_threshold,
-                        cellprob_threshold=cellprob_threshold,
-                        stitch_threshold=stitch_threshold,
-                        tile=True,
-                        do_3D=do_3D,
-                    )
-                    for _x in tqdm(image)
-                )
-            )
+        cellres = _time_lapse(
+            lambda t: cellpose_model.eval(
+                image[t],
+                diameter=diameter_cellpose,
+                channels=channels,
+                flow_threshold=flow_threshold,
+                cellprob_threshold=cellprob_threshold,
+                stitch_threshold=stitch_threshold,
+                tile=True,
+                do_3D=do_3D,
+            ),
+            len(image),
+            n_workers=1,
         )
 
     return cellres
@@ -1489,6 +1617,8 @@ def CellPoseSeg(
     channels=[0, 0],
 ):
 
+    from cellpose import models
+
     if len(image.shape) == 3 and "T" not in axes:
         if cellpose_model_path is not None:
             cellpose_model = models.CellposeModel(
@@ -1529,41 +1659,35 @@ def CellPoseSeg(
             gpu=gpu, pretrained_model=cellpose_model_path
         )
         if anisotropy is not None:
-            cellres = tuple(
-                zip(
-                    *tuple(
-                        cellpose_model.eval(
-                            _x,
-                            diameter=diameter_cellpose,
-                            channels=channels,
-                            flow_threshold=flow_threshold,
-                            cellprob_threshold=cellprob_threshold,
-                            stitch_threshold=stitch_threshold,
-                            anisotropy=anisotropy,
-                            tile=True,
-                            do_3D=do_3D,
-                        )
-                        for _x in tqdm(image)
-                    )
-                )
+            cellres = _time_lapse(
+                lambda t: cellpose_model.eval(
+                    image[t],
+                    diameter=diameter_cellpose,
+                    channels=channels,
+                    flow_threshold=flow_threshold,
+                    cellprob_threshold=cellprob_threshold,
+                    stitch_threshold=stitch_threshold,
+                    anisotropy=anisotropy,
+                    tile=True,
+                    do_3D=do_3D,
+                ),
+                len(image),
+                n_workers=1,
             )
         else:
-            cellres = tuple(
-                zip(
-                    *tuple(
-                        cellpose_model.eval(
-                            _x,
-                            diameter=diameter_cellpose,
-                            channels=channels,
-                            flow_threshold=flow_threshold,
-                            cellprob_threshold=cellprob_threshold,
-                            stitch_threshold=stitch_threshold,
-                            tile=True,
-                            do_3D=do_3D,
-                        )
-                        for _x in tqdm(image)
-                    )
-                )
+            cellres = _time_lapse(
+                lambda t: cellpose_model.eval(
+                    image[t],
+                    diameter=diameter_cellpose,
+                    channels=channels,
+                    flow_threshold=flow_threshold,
+                    cellprob_threshold=cellprob_threshold,
+                    stitch_threshold=stitch_threshold,
+                    tile=True,
+                    do_3D=do_3D,
+                ),
+                len(image),
+                n_workers=1,
             )
 
     if cellpose_model_path is not None or cellpose_model_type is not None:
@@ -1688,6 +1812,7 @@ def VollOne(
     save_dir: str = None,
     Name: str = "Result",
     axes: str = "CZYX",
+    n_workers: int = 1,
 ):
 
     channel_index = axes.index("C")
@@ -1702,31 +1827,33 @@ def VollOne(
 
         image_membrane = np.take(image, channel_membrane, axis=channel_index)
         image_nuclei = np.take(image, channel_nuclei, axis=channel_index)
-        nuclei_res = tuple(
-            zip(
-                *tuple(
-                    VollSeg(
-                        image_nuclei[i],
-                        unet_model=unet_model_nuclei,
-                        star_model=star_model_nuclei,
-                        axes=(axes.replace("C", "")).replace("T", ""),
-                        prob_thresh=prob_thresh,
-                        nms_thresh=nms_thresh,
-                        min_size_mask=min_size_mask,
-                        min_size=min_size,
-                        max_size=max_size,
-                        n_tiles=n_tiles,
-                        UseProbability=UseProbability,
-                        donormalize=donormalize,
-                        lower_perc=lower_perc,
-                        upper_perc=upper_perc,
-                        dounet=dounet,
-                        seedpool=seedpool,
-                        slice_merge=slice_merge_nuclei,
-                    )
-                    for i in tqdm(range(image_nuclei.shape[0]))
-                )
+
+        def _nuclei_frame(i, unet_model_nuclei, star_model_nuclei):
+            return VollSeg(
+                image_nuclei[i],
+                unet_model=unet_model_nuclei,
+                star_model=star_model_nuclei,
+                axes=(axes.replace("C", "")).replace("T", ""),
+                prob_thresh=prob_thresh,
+                nms_thresh=nms_thresh,
+                min_size_mask=min_size_mask,
+                min_size=min_size,
+                max_size=max_size,
+                n_tiles=n_tiles,
+                UseProbability=UseProbability,
+                donormalize=donormalize,
+                lower_perc=lower_perc,
+                upper_perc=upper_perc,
+                dounet=dounet,
+                seedpool=seedpool,
+                slice_merge=slice_merge_nuclei,
             )
+
+        nuclei_res = _time_lapse(
+            _nuclei_frame,
+            image_nuclei.shape[0],
+            (unet_model_nuclei, star_model_nuclei),
+            n_workers,
         )
         (
             nuclei_sized_smart_seeds,
@@ -1744,24 +1871,25 @@ def VollOne(
         for i in range(nuclei_markers.shape[0]):
             nuclei_markers[i] = clear_border(nuclei_markers[i])
 
-        membrane_res = tuple(
-            zip(
-                *tuple(
-                    VollSeg_unet(
-                        image_membrane[i],
-                        unet_model=unet_model_membrane,
-                        noise_model=noise_model_membrane,
-                        roi_model=roi_model,
-                        axes=(axes.replace("C", "")).replace("T", ""),
-                        min_size_mask=min_size_mask,
-                        max_size=max_size,
-                        n_tiles=n_tiles,
-                        ExpandLabels=ExpandLabels,
-                        slice_merge=slice_merge_membrane,
-                    )
-                    for i in tqdm(range(image_membrane.shape[0]))
-                )
+        def _membrane_frame(i, unet_model_membrane, noise_model_membrane, roi_model):
+            return VollSeg_unet(
+                image_membrane[i],
+                unet_model=unet_model_membrane,
+                noise_model=noise_model_membrane,
+                roi_model=roi_model,
+                axes=(axes.replace("C", "")).replace("T", ""),
+                min_size_mask=min_size_mask,
+                max_size=max_size,
+                n_tiles=n_tiles,
+                ExpandLabels=ExpandLabels,
+                slice_merge=slice_merge_membrane,
             )
+
+        membrane_res = _time_lapse(
+            _membrane_frame,
+            image_membrane.shape[0],
+            (unet_model_membrane, noise_model_membrane, roi_model),
+            n_workers,
         )
 
         if roi_model is not None:
@@ -1977,6 +2105,56 @@ def VollOne(
     return nuclei_res, membrane_res
 
 
+def _vollseg_outputs(unet_model, star_model, noise_model, roi_model):
+    """
+    Names of the VollSeg outputs in the order they are returned, the ones
+    written to save_dir by default and the dtype they are written with
+    """
+    if star_model is not None:
+        names = [
+            "VollSeg",
+            "BinaryMask",
+            "StarDist",
+            "Probability",
+            "Markers",
+            "Skeleton",
+        ]
+        if noise_model is not None:
+            names += ["Denoised"]
+    elif unet_model is None and noise_model is None:
+        names = ["BinaryMask"]
+    else:
+        names = ["BinaryMask", "Skeleton", "Denoised"]
+    if roi_model is not None:
+        names += ["Roi"]
+
+    saved = set(names)
+    if unet_model is None:
+        saved.discard("BinaryMask")
+        if star_model is None:
+            saved.discard("Skeleton")
+    if noise_model is None:
+        saved.discard("Denoised")
+
+    dtypes = {name: "uint16" for name in names}
+    dtypes.update(Probability="float32", Denoised="float32")
+    if star_model is not None:
+        dtypes["Skeleton"] = None
+    return names, saved, dtypes
+
+
+def _save_outputs(save_dir, Name, outputs, dtypes):
+
+    Path(save_dir).mkdir(exist_ok=True)
+    for folder, x in outputs.items():
+        results = Path(save_dir) / folder
+        Path(results).mkdir(exist_ok=True)
+        x = np.asarray(x)
+        if dtypes.get(folder) is not None:
+            x = x.astype(dtypes[folder])
+        imwrite(os.path.join(results.as_posix(), Name + ".tif"), x)
+
+
 def VollSeg(
     image: np.ndarray,
     unet_model: Union[UNET, None] = None,
@@ -2001,8 +2179,42 @@ def VollSeg(
     Name="Result",
     slice_merge=False,
     RGB=False,
+    n_workers=1,
+    save_format="tif",
+    save_outputs=None,
+    compression=None,
 ):
 
+    arguments = dict(locals())
+    output_names, saved_outputs, output_dtypes = _vollseg_outputs(
+        unet_model, star_model, noise_model, roi_model
+    )
+    if save_outputs is not None:
+        saved_outputs = set(save_outputs)
+    writer = None
+    stream = {}
+    time_lapse = len(image.shape) == 4 or (len(image.shape) == 3 and "T" in axes)
+    if save_dir is not None and save_format != "tif" and time_lapse:
+        # time points go to disk as they finish, a rerun on the same input
+        # with the same parameters resumes after them
+        params = {
+            name: value
+            for name, value in arguments.items()
+            if name not in ("image", "save_dir", "Name", "n_workers")
+        }
+        writer = FrameWriter(
+            save_dir,
+            Name,
+            output_names,
+            len(image),
+            persist=saved_outputs,
+            save_format=save_format,
+            compression=compression,
+            dtypes=output_dtypes,
+            fingerprint=frame_fingerprint(image, VollSeg, params),
+        )
+        stream = dict(out=writer.stacks, skip=writer.done, callback=writer.mark_done)
+
     if len(image.shape) == 2:
 
         # if the default tiling of the function is not changed by the user, we use the last two tuples
@@ -2143,90 +2355,101 @@ def VollSeg(
         if len(n_tiles) == 3:
             n_tiles = (n_tiles[1], n_tiles[2])
         if star_model is not None:
-            res = tuple(
-                zip(
-                    *tuple(
-                        VollSeg2D(
-                            _x,
-                            unet_model,
-                            star_model,
-                            noise_model=noise_model,
-                            ExpandLabels=ExpandLabels,
-                            roi_model=roi_model,
-                            prob_thresh=prob_thresh,
-                            nms_thresh=nms_thresh,
-                            donormalize=donormalize,
-                            lower_perc=lower_perc,
-                            upper_perc=upper_perc,
-                            axes=axes,
-                            min_size_mask=min_size_mask,
-                            min_size=min_size,
-                            max_size=max_size,
-                            dounet=dounet,
-                            n_tiles=n_tiles,
-                            UseProbability=UseProbability,
-                            RGB=RGB,
-                        )
-                        for _x in tqdm(image)
-                    )
+
+            def _frame(t, unet_model, star_model, noise_model, roi_model):
+                return VollSeg2D(
+                    image[t],
+                    unet_model,
+                    star_model,
+                    noise_model=noise_model,
+                    ExpandLabels=ExpandLabels,
+                    roi_model=roi_model,
+                    prob_thresh=prob_thresh,
+                    nms_thresh=nms_thresh,
+                    donormalize=donormalize,
+                    lower_perc=lower_perc,
+                    upper_perc=upper_perc,
+                    axes=axes,
+                    min_size_mask=min_size_mask,
+                    min_size=min_size,
+                    max_size=max_size,
+                    dounet=dounet,
+                    n_tiles=n_tiles,
+                    UseProbability=UseProbability,
+                    RGB=RGB,
                 )
+
+            res = _time_lapse(
+                _frame,
+                len(image),
+                (unet_model, star_model, noise_model, roi_model),
+                n_workers,
+                **stream,
             )
         if star_model is None:
 
-            res = tuple(
-                zip(
-                    *tuple(
-                        VollSeg_unet(
-                            _x,
-                            unet_model=unet_model,
-                            roi_model=roi_model,
-                            ExpandLabels=ExpandLabels,
-                            n_tiles=n_tiles,
-                            axes=axes,
-                            noise_model=noise_model,
-                            RGB=RGB,
-                            slice_merge=slice_merge,
-                            nms_thresh=nms_thresh,
-                            dounet=dounet,
-                        )
-                        for _x in tqdm(image)
-                    )
+            def _frame(t, unet_model, star_model, noise_model, roi_model):
+                return VollSeg_unet(
+                    image[t],
+                    unet_model=unet_model,
+                    roi_model=roi_model,
+                    ExpandLabels=ExpandLabels,
+                    n_tiles=n_tiles,
+                    axes=axes,
+                    noise_model=noise_model,
+                    RGB=RGB,
+                    slice_merge=slice_merge,
+                    nms_thresh=nms_thresh,
+                    dounet=dounet,
                 )
+
+            res = _time_lapse(
+                _frame,
+                len(image),
+                (unet_model, star_model, noise_model, roi_model),
+                n_workers,
+                **stream,
             )
 
     if len(image.shape) == 4:
         if len(n_tiles) == 4:
             n_tiles = (n_tiles[1], n_tiles[2], n_tiles[3])
-        res = tuple(
-            zip(
-                *tuple(
-                    VollSeg3D(
-                        _x,
-                        unet_model,
-                        star_model,
-                        axes=axes,
-                        noise_model=noise_model,
-                        roi_model=roi_model,
-                        ExpandLabels=ExpandLabels,
-                        prob_thresh=prob_thresh,
-                        nms_thresh=nms_thresh,
-                        donormalize=donormalize,
-                        lower_perc=lower_perc,
-                        upper_perc=upper_perc,
-                        min_size_mask=min_size_mask,
-                        min_size=min_size,
-                        max_size=max_size,
-                        n_tiles=n_tiles,
-                        UseProbability=UseProbability,
-                        dounet=dounet,
-                        seedpool=seedpool,
-                        slice_merge=slice_merge,
-                    )
-                    for _x in tqdm(image)
-                )
+
+        def _frame(t, unet_model, star_model, noise_model, roi_model):
+            return VollSeg3D(
+                image[t],
+                unet_model,
+                star_model,
+                axes=axes,
+                noise_model=noise_model,
+                roi_model=roi_model,
+                ExpandLabels=ExpandLabels,
+                prob_thresh=prob_thresh,
+                nms_thresh=nms_thresh,
+                donormalize=donormalize,
+                lower_perc=lower_perc,
+                upper_perc=upper_perc,
+                min_size_mask=min_size_mask,
+                min_size=min_size,
+                max_size=max_size,
+                n_tiles=n_tiles,
+                UseProbability=UseProbability,
+                dounet=dounet,
+                seedpool=seedpool,
+                slice_merge=slice_merge,
             )
+
+        res = _time_lapse(
+            _frame,
+            len(image),
+            (unet_model, star_model, noise_model, roi_model),
+            n_workers,
+            **stream,
         )
 
+    if writer is not None:
+        res = writer.close()
+
     if noise_model is None and star_model is not None and roi_model is not None:
         (
             sized_smart_seeds,
@@ -2315,7 +2538,7 @@ def VollSeg(
     ):
 
         instance_labels, roi_image = res
-        skeleton = Skel(instance_labels)
+        skeleton = None if instance_labels is None else Skel(instance_labels)
 
     if (
         star_model is None
@@ -2335,69 +2558,13 @@ def VollSeg(
 
         instance_labels, skeleton, image, roi_image = res
 
-    if save_dir is not None:
-        Path(save_dir).mkdir(exist_ok=True)
-
-        if roi_model is not None:
-            roi_results = Path(save_dir) / "Roi"
-            Path(roi_results).mkdir(exist_ok=True)
-            imwrite(
-                os.path.join(roi_results.as_posix(), Name + ".tif"),
-                np.asarray(roi_image).astype("uint16"),
-            )
-
-        if unet_model is not None:
-            unet_results = Path(save_dir) / "BinaryMask"
-            skel_unet_results = Path(save_dir) / "Skeleton"
-            Path(unet_results).mkdir(exist_ok=True)
-            Path(skel_unet_results).mkdir(exist_ok=True)
-
-            imwrite(
-                os.path.join(unet_results.as_posix(), Name + ".tif"),
-                np.asarray(instance_labels).astype("uint16"),
-            )
-            imwrite(
-                os.path.join(skel_unet_results.as_posix(), Name + ".tif"),
-                np.asarray(skeleton).astype("uint16"),
-            )
-        if star_model is not None:
-            vollseg_results = Path(save_dir) / "VollSeg"
-            stardist_results = Path(save_dir) / "StarDist"
-            probability_results = Path(save_dir) / "Probability"
-            marker_results = Path(save_dir) / "Markers"
-            skel_results = Path(save_dir) / "Skeleton"
-            Path(skel_results).mkdir(exist_ok=True)
-            Path(vollseg_results).mkdir(exist_ok=True)
-            Path(stardist_results).mkdir(exist_ok=True)
-            Path(probability_results).mkdir(exist_ok=True)
-            Path(marker_results).mkdir(exist_ok=True)
-            imwrite(
-                os.path.join(stardist_results.as_posix(), Name + ".tif"),
-                np.asarray(star_labels).astype("uint16"),
-            )
-            imwrite(
-                os.path.join(vollseg_results.as_posix(), Name + ".tif"),
-                np.asarray(sized_smart_seeds).astype("uint16"),
-            )
-            imwrite(
-                os.path.join(probability_results.as_posix(), Name + ".tif"),
-                np.asarray(probability_map).astype("float32"),
-            )
-            imwrite(
-                os.path.join(marker_results.as_posix(), Name + ".tif"),
-                np.asarray(markers).astype("uint16"),
-            )
-            imwrite(
-                os.path.join(skel_results.as_posix(), Name + ".tif"),
-                np.asarray(skeleton),
-            )
-        if noise_model is not None:
-            denoised_results = Path(save_dir) / "Denoised"
-            Path(denoised_results).mkdir(exist_ok=True)
-            imwrite(
-                os.path.join(denoised_results.as_posix(), Name + ".tif"),
-                np.asarray(image).astype("float32"),
-            )
+    if save_dir is not None and writer is None:
+        _save_outputs(
+            save_dir,
+            Name,
+            {name: x for name, x in zip(output_names, res) if name in saved_outputs},
+            output_dtypes,
+        )
 
     # If denoising is not done but stardist and unet models are supplied we return the stardist, vollseg and semantic segmentation maps
     if noise_model is None and star_model is not None and roi_model is not None:
@@ -3170,107 +3337,67 @@ def SuperVollSeg(
         return instance_labels_nuclei.astype("uint16")
 
 
-def image_pixel_duplicator(image, size):
+def image_pixel_duplicator(image, size, copy=True):
+    """Repeat image along every axis until it fills size.
 
+    The image is repeated with one row of zeros between the copies and
+    sizes smaller than the image are raised to the image size. The
+    output keeps the dtype of image and is built in a single allocation;
+    with copy=False the input itself is returned when no repetition is
+    needed.
+    """
     assert len(image.shape) == len(
         size
     ), f"The provided size {len(size)} should match the image dimensions {len(image.shape)}"
 
-    model_dim = len(size)
-
-    if model_dim == 3:
-        size_y = size[0]
-        size_x = size[1]
-        size_z = size[2]
-        if size_y <= image.shape[0]:
-            size_y = image.shape[0]
-        if size_x <= image.shape[1]:
-            size_x = image.shape[1]
-        if size_z <= image.shape[2]:
-            size_z = image.shape[2]
-
-        size = (size_y, size_x, size_z)
-        ResizeImage = np.zeros(size)
-        j = 0
-        for i in range(0, ResizeImage.shape[1]):
-
-            if j < image.shape[1]:
-                ResizeImage[: image.shape[0], i, : image.shape[2]] = image[
-                    : image.shape[0], j, : image.shape[2]
-                ]
-                j = j + 1
-            else:
-                j = 0
-
-        j = 0
-        for i in range(0, ResizeImage.shape[2]):
-
-            if j < image.shape[2]:
-                ResizeImage[:, :, i] = ResizeImage[:, :, j]
-                j = j + 1
-            else:
-                j = 0
-
-        j = 0
-        for i in range(0, ResizeImage.shape[0]):
-
-            if j < image.shape[0]:
-                ResizeImage[i, :, :] = ResizeImage[j, :, :]
-                j = j + 1
-            else:
-                j = 0
-
-    if model_dim == 2:
-
-        size_y = size[0]
-        size_x = size[1]
-        if size_y <= image.shape[0]:
-            size_y = image.shape[0]
-        if size_x <= image.shape[1]:
-            size_x = image.shape[1]
-
-        size = (size_y, size_x)
-
-        ResizeImage = np.zeros(size)
-        j = 0
-        for i in range(0, ResizeImage.shape[1]):
-
-            if j < image.shape[1]:
-                ResizeImage[: image.shape[0], i] = image[: image.shape[0], j]
-                j = j + 1
-            else:
-                j = 0
-
-        j = 0
-        for i in range(0, ResizeImage.shape[0]):
+    size = tuple(max(s, n) for s, n in zip(size, image.shape))
+    if not copy and size == image.shape:
+        return image
 
-            if j < image.shape[0]:
-                ResizeImage[i, :] = ResizeImage[j, :]
-                j = j + 1
-            else:
-                j = 0
+    # index n of every period of n + 1 picks the appended zero row
+    padded = np.pad(image, [(0, 1)] * image.ndim, "constant", constant_values=0)
+    indices = [np.arange(s) % (n + 1) for s, n in zip(size, image.shape)]
+    ResizeImage = padded[np.ix_(*indices)]
 
     return ResizeImage
 
 
-def image_conditionals(image, pixel_condition, pixel_replace_condition):
-
-    indices = zip(*np.where(pixel_condition))
-    for index in indices:
+def image_conditionals(image, pixel_condition, pixel_replace_condition, out=None):
+    """Set the pixels where pixel_condition holds to pixel_replace_condition.
 
-        image[index] = pixel_replace_condition
-
-    return image
+    Works in place on image (or on out, which receives a copy of image
+    first) and keeps the dtype of the output array.
+    """
+    if out is None:
+        out = image
+    elif out is not image:
+        np.copyto(out, image, casting="unsafe")
+    np.copyto(out, pixel_replace_condition, casting="unsafe", where=pixel_condition)
 
+    return out
 
-def image_addition_conditionals(image, pixel_condition, pixel_replace_condition):
 
-    indices = zip(*np.where(pixel_condition))
-    for index in indices:
+def image_addition_conditionals(
+    image, pixel_condition, pixel_replace_condition, out=None
+):
+    """Add pixel_replace_condition to the pixels where pixel_condition holds.
 
-        image[index] = image[index] + pixel_replace_condition
+    Works in place on image (or on out, which receives a copy of image
+    first) and keeps the dtype of the output array.
+    """
+    if out is None:
+        out = image
+    elif out is not image:
+        np.copyto(out, image, casting="unsafe")
+    np.add(
+        out,
+        pixel_replace_condition,
+        out=out,
+        where=np.broadcast_to(pixel_condition, out.shape),
+        casting="unsafe",
+    )
 
-    return image
+    return out
 
 
 def image_embedding(image, size):
@@ -3285,24 +3412,14 @@ def image_embedding(image, size):
                 image.shape[i] <= size[i]
             ), f"The image size should be smaller \
             than the volume it is to be embedded in but found image of size {image.shape[i]} for dimension{i}"
-            width = []
-            for i in range(len(size)):
-                width.append(size[i] - image.shape[i])
-            width = np.asarray(width)
-
-            ResizeImage = np.pad(image, width, "constant", constant_values=0)
+        width = [size[i] - image.shape[i] for i in range(len(size))]
+        ResizeImage = np.pad(image, [width] * 2, "constant", constant_values=0)
     if model_dim == 3:
-        ResizeImage = []
-        width = []
-        for i in range(len(size)):
-            width.append(size[i] - image.shape[i + 1])
-        width = np.asarray(width)
-        for i in range(image.shape[0]):
-
-            ResizeImage.append(
-                np.pad(image[i, :], width, "constant", constant_values=0)
-            )
-        ResizeImage = np.asarray(ResizeImage)
+        # pad all slices at once instead of stacking padded slices
+        width = [size[i] - image.shape[i + 1] for i in range(len(size))]
+        ResizeImage = np.pad(
+            image, [(0, 0)] + [width] * 2, "constant", constant_values=0
+        )
     return ResizeImage
 
 
@@ -3344,20 +3461,24 @@ def stitch3D(masks, stitch_threshold=0.25):
     for i in range(len(masks) - 1):
         if masks[i].max() > 0 and masks[i + 1].max() > 0:
             iou = _intersection_over_union(masks[i + 1], masks[i])[1:, 1:]
-            if not iou.size and empty == 0:
+            iou_size = iou.shape[0] * iou.shape[1]
+            if not iou_size and empty == 0:
                 masks[i + 1] = masks[i + 1]
                 mmax = masks[i + 1].max()
-            elif not iou.size and not empty == 0:
+            elif not iou_size and not empty == 0:
                 icount = masks[i + 1].max()
                 istitch = np.arange(mmax + 1, mmax + icount + 1, 1, int)
                 mmax += icount
                 istitch = np.append(np.array(0), istitch)
                 masks[i + 1] = istitch[masks[i + 1]]
             else:
-                iou[iou < stitch_threshold] = 0.0
-                iou[iou < iou.max(axis=0)] = 0.0
-                istitch = iou.argmax(axis=1) + 1
-                ino = np.nonzero(iou.max(axis=1) == 0.0)[0]
+                if issparse(iou):
+                    istitch, ino = _sparse_stitch(iou, stitch_threshold)
+                else:
+                    iou[iou < stitch_threshold] = 0.0
+                    iou[iou < iou.max(axis=0)] = 0.0
+                    istitch = iou.argmax(axis=1) + 1
+                    ino = np.nonzero(iou.max(axis=1) == 0.0)[0]
                 istitch[ino] = np.arange(mmax + 1, mmax + len(ino) + 1, 1, int)
                 mmax += len(ino)
                 istitch = np.append(np.array(0), istitch)
@@ -3367,9 +3488,95 @@ def stitch3D(masks, stitch_threshold=0.25):
     return masks
 
 
+def _sparse_stitch(iou, stitch_threshold):
+    """sparse version of the stitch3D label assignment
+
+    Returns the matched label (1-based) for every row of iou and the rows
+    without a match, with the same tie breaking as the dense argmax.
+    """
+    iou = iou.tocoo()
+    keep = (iou.data >= stitch_threshold) & (iou.data > 0)
+    rows, cols, values = iou.row[keep], iou.col[keep], iou.data[keep]
+    colmax = np.zeros(iou.shape[1])
+    np.maximum.at(colmax, cols, values)
+    keep = values >= colmax[cols]
+    rows, cols, values = rows[keep], cols[keep], values[keep]
+    order = np.lexsort((cols, -values, rows))
+    rows, cols = rows[order], cols[order]
+    first = np.ones(len(rows), dtype=bool)
+    first[1:] = rows[1:] != rows[:-1]
+    istitch = np.ones(iou.shape[0], int)
+    istitch[rows[first]] = cols[first] + 1
+    matched = np.zeros(iou.shape[0], dtype=bool)
+    matched[rows[first]] = True
+    ino = np.nonzero(~matched)[0]
+    return istitch, ino
+
+
+def _sparse_assignment(iou, th):
+    """linear sum assignment restricted to the overlapping label pairs
+
+    The cost of the dense assignment is zero for every pair without
+    overlap, so the problem splits into the connected components of the
+    overlap graph, which are solved one at a time.
+
+    Returns
+    ------------
+
+    true_ind, pred_ind: ND-array, int
+        matched pairs with non-zero IoU
+    matched_iou: ND-array, float
+        IoU of the matched pairs
+
+    """
+    iou = iou.tocoo()
+    keep = iou.data > 0
+    rows, cols, values = iou.row[keep], iou.col[keep], iou.data[keep]
+    n_true, n_pred = iou.shape
+    n_min = min(n_true, n_pred)
+    graph = csr_matrix(
+        (np.ones(len(rows)), (rows, cols + n_true)),
+        shape=(n_true + n_pred, n_true + n_pred),
+    )
+    _, component = connected_components(graph, directed=False)
+    order = np.argsort(component[rows], kind="stable")
+    rows, cols, values = rows[order], cols[order], values[order]
+    splits = np.flatnonzero(np.diff(component[rows])) + 1
+    true_ind, pred_ind, matched_iou = [], [], []
+    for r, c, v in zip(
+        np.split(rows, splits), np.split(cols, splits), np.split(values, splits)
+    ):
+        if len(r) == 0:
+            continue
+        true_labels, r = np.unique(r, return_inverse=True)
+        pred_labels, c = np.unique(c, return_inverse=True)
+        block = np.zeros((len(true_labels), len(pred_labels)))
+        block[r, c] = v
+        costs = -(block >= th).astype(float) - block / (2 * n_min)
+        block_true, block_pred = linear_sum_assignment(costs)
+        ok = block[block_true, block_pred] > 0
+        true_ind.append(true_labels[block_true[ok]])
+        pred_ind.append(pred_labels[block_pred[ok]])
+        matched_iou.append(block[block_true[ok], block_pred[ok]])
+    if len(true_ind) == 0:
+        return np.zeros(0, int), np.zeros(0, int), np.zeros(0)
+    return (
+        np.concatenate(true_ind),
+        np.concatenate(pred_ind),
+        np.concatenate(matched_iou),
+    )
+
+
 def mask_ious(masks_true, masks_pred):
     """return best-matched masks"""
     iou = _intersection_over_union(masks_true, masks_pred)[1:, 1:]
+    if issparse(iou):
+        true_ind, pred_ind, matched_iou = _sparse_assignment(iou, 0.5)
+        iout = np.zeros(masks_true.max())
+        iout[true_ind] = matched_iou
+        preds = np.zeros(masks_true.max(), "int")
+        preds[true_ind] = pred_ind + 1
+        return iout, preds
     n_min = min(iou.shape[0], iou.shape[1])
     costs = -(iou >= 0.5).astype(float) - iou / (2 * n_min)
     true_ind, pred_ind = linear_sum_assignment(costs)
@@ -3420,6 +3627,8 @@ def masks_to_outlines(masks):
         size [Ly x Lx] or [Lz x Ly x Lx], True pixels are outlines
 
     """
+    import cv2
+
     if masks.ndim > 3 or masks.ndim < 2:
         raise ValueError(
             "masks_to_outlines takes 2D or 3D array, not %dD array" % masks.ndim
@@ -3493,10 +3702,17 @@ def aggregated_jaccard_index(masks_true, masks_pred):
     for n in range(len(masks_true)):
         iout, preds = mask_ious(masks_true[n], masks_pred[n])
         inds = np.arange(0, masks_true[n].max(), 1, int)
-        overlap = _label_overlap(masks_true[n], masks_pred[n])
+        overlap = _label_overlap(
+            masks_true[n],
+            masks_pred[n],
+            sparse=_sparse_overlap(masks_true[n], masks_pred[n]),
+        )
         union = np.logical_or(masks_true[n] > 0, masks_pred[n] > 0).sum()
-        overlap = overlap[inds[preds > 0] + 1, preds[preds > 0].astype(int)]
-        aji[n] = overlap.sum() / union
+        if preds.any():
+            overlap = overlap[inds[preds > 0] + 1, preds[preds > 0].astype(int)]
+        else:
+            overlap = np.zeros(0)
+        aji[n] = np.asarray(overlap).sum() / union
     return aji
 
 
@@ -3562,8 +3778,12 @@ def average_precision(masks_true, masks_pred, threshold=[0.5, 0.75, 0.9]):
     return ap, tp, fp, fn
 
 
-@jit(nopython=True)
-def _label_overlap(x, y):
+def _sparse_overlap(x, y):
+    """whether the overlap matrix of x and y is too large to be built dense"""
+    return (int(np.max(x)) + 1) * (int(np.max(y)) + 1) > GLOBAL_DENSE_OVERLAP
+
+
+def _label_overlap(x, y, sparse=False):
     """fast function to get pixel overlaps between masks in x and y
 
     Parameters
@@ -3573,33 +3793,43 @@ def _label_overlap(x, y):
         where 0=NO masks; 1,2... are mask labels
     y: ND-array, int
         where 0=NO masks; 1,2... are mask labels
+    sparse: bool
+        return a scipy.sparse CSR matrix holding only the label pairs
+        that actually overlap instead of the dense matrix
 
     Returns
     ------------
 
-    overlap: ND-array, int
+    overlap: ND-array or CSR matrix, int
         matrix of pixel overlaps of size [x.max()+1, y.max()+1]
 
     """
-    # put label arrays into standard form then flatten them
-    #     x = (utils.format_labels(x)).ravel()
-    #     y = (utils.format_labels(y)).ravel()
-    x = x.ravel()
-    y = y.ravel()
-
-    # preallocate a 'contact map' matrix
-    overlap = np.zeros((1 + x.max(), 1 + y.max()), dtype=np.uint)
-
-    # loop over the labels in x and add to the corresponding
-    # overlap entry. If label A in x and label B in y share P
-    # pixels, then the resulting overlap is P
-    # len(x)=len(y), the number of pixels in the whole image
-    for i in range(len(x)):
-        overlap[x[i], y[i]] += 1
-    return overlap
-
-
-def _intersection_over_union(masks_true, masks_pred):
+    x = np.asarray(x).ravel()
+    y = np.asarray(y).ravel()
+    n_x = int(x.max()) + 1
+    n_y = int(y.max()) + 1
+
+    # combine every (x, y) label pair into a single key and count the keys,
+    # if label A in x and label B in y share P pixels the count of their
+    # key is P
+    if sparse:
+        foreground = (x > 0) | (y > 0)
+        key = x[foreground].astype(np.int64) * n_y + y[foreground]
+        key, counts = np.unique(key, return_counts=True)
+        rows, cols = np.divmod(key, n_y)
+        n_background = len(x) - int(counts.sum())
+        if n_background > 0:
+            rows = np.append(rows, 0)
+            cols = np.append(cols, 0)
+            counts = np.append(counts, n_background)
+        return csr_matrix((counts.astype(np.uint), (rows, cols)), shape=(n_x, n_y))
+
+    key = x.astype(np.int64) * n_y + y
+    overlap = np.bincount(key, minlength=n_x * n_y).reshape(n_x, n_y)
+    return overlap.astype(np.uint)
+
+
+def _intersection_over_union(masks_true, masks_pred, sparse=None):
     """intersection over union of all mask pairs
 
     Parameters
@@ -3609,11 +3839,14 @@ def _intersection_over_union(masks_true, masks_pred):
         ground truth masks, where 0=NO masks; 1,2... are mask labels
     masks_pred: ND-array, int
         predicted masks, where 0=NO masks; 1,2... are mask labels
+    sparse: bool or None
+        build the IoU matrix as a CSR matrix of the overlapping pairs only,
+        by default when it would have more than GLOBAL_DENSE_OVERLAP entries
 
     Returns
     ------------
 
-    iou: ND-array, float
+    iou: ND-array or CSR matrix, float
         matrix of IOU pairs of size [x.max()+1, y.max()+1]
 
     ------------
@@ -3633,7 +3866,21 @@ def _intersection_over_union(masks_true, masks_pred):
         subtracted to find the union matrix.
 
     """
-    overlap = _label_overlap(masks_true, masks_pred)
+    if sparse is None:
+        sparse = _sparse_overlap(masks_true, masks_pred)
+    overlap = _label_overlap(masks_true, masks_pred, sparse=sparse)
+    if sparse:
+        overlap = overlap.tocoo()
+        n_pixels_pred = np.bincount(
+            overlap.col, weights=overlap.data, minlength=overlap.shape[1]
+        )
+        n_pixels_true = np.bincount(
+            overlap.row, weights=overlap.data, minlength=overlap.shape[0]
+        )
+        iou = overlap.data / (
+            n_pixels_pred[overlap.col] + n_pixels_true[overlap.row] - overlap.data
+        )
+        return csr_matrix((iou, (overlap.row, overlap.col)), shape=overlap.shape)
     n_pixels_pred = np.sum(overlap, axis=0, keepdims=True)
     n_pixels_true = np.sum(overlap, axis=1, keepdims=True)
     iou = overlap / (n_pixels_pred + n_pixels_true - overlap)
@@ -3674,6 +3921,18 @@ def _true_positive(iou, th):
 
     """
     n_min = min(iou.shape[0], iou.shape[1])
+    if issparse(iou):
+        # the count of the optimal assignment is the maximum matching
+        # among the pairs at or above the threshold
+        if th <= 0:
+            return n_min
+        iou = iou.tocoo()
+        keep = iou.data >= th
+        graph = csr_matrix(
+            (np.ones(keep.sum()), (iou.row[keep], iou.col[keep])), shape=iou.shape
+        )
+        matched = maximum_bipartite_matching(graph, perm_type="column")
+        return (matched >= 0).sum()
     costs = -(iou >= th).astype(float) - iou / (2 * n_min)
     true_ind, pred_ind = linear_sum_assignment(costs)
     match_ok = iou[true_ind, pred_ind] >= th
@@ -3785,7 +4044,8 @@ def masks_to_flows_cpu(masks):
     return mu, mu_c
 
 
-@njit("(float64[:], int32[:], int32[:], int32, int32, int32, int32)", nogil=True)
+# compiled on first use, an explicit signature would compile it on import
+@njit(nogil=True)
 def _extend_centers(T, y, x, ymed, xmed, Lx, niter):
     """run diffusion from center of mask (ymed, xmed) on mask pixels (y, x)
     Parameters
@@ -3856,6 +4116,9 @@ def masks_to_flows(masks):
         in which it resides
 
     """
+    import torch
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     if masks.max() == 0:
         return np.zeros((2, *masks.shape), "float32")
 
@@ -3886,13 +4149,12 @@ def merge_labels_across_volume(labelvol, relabelfunc, threshold=3):
     nz, ny, nx = labelvol.shape
     res = np.zeros_like(labelvol)
     res[0, ...] = labelvol[0, ...]
-    backup = labelvol.copy()  # kapoors code modifies the input array
     for i in tqdm(range(nz - 1)):
 
+        # hand over a copy of the slice only, relabelfunc may modify it
         res[i + 1, ...] = relabelfunc(
-            res[i, ...], labelvol[i + 1, ...], threshold=threshold
+            res[i, ...], labelvol[i + 1, ...].copy(), threshold=threshold
         )
-        labelvol = backup.copy()  # restore the input array
     res = res.astype("uint16")
     return res
 
@@ -3900,44 +4162,42 @@ def merge_labels_across_volume(labelvol, relabelfunc, threshold=3):
 def RelabelZ(previousImage, currentImage, threshold):
 
     currentImage = currentImage.astype("uint16")
-    relabelimage = currentImage
     previousImage = previousImage.astype("uint16")
     waterproperties = measure.regionprops(previousImage)
-    indices = [prop.centroid for prop in waterproperties]
-    if len(indices) > 0:
-        tree = spatial.cKDTree(indices)
-        currentwaterproperties = measure.regionprops(currentImage)
-        currentindices = [prop.centroid for prop in currentwaterproperties]
-        if len(currentindices) > 0:
-            for i in range(0, len(currentindices)):
-                index = currentindices[i]
-                currentlabel = currentImage[int(index[0]), int(index[1])]
-                if currentlabel > 0:
-                    previouspoint = tree.query(index)
-                    previouslabel = previousImage[
-                        int(indices[previouspoint[1]][0]),
-                        int(indices[previouspoint[1]][1]),
-                    ]
-                    if previouspoint[0] > threshold:
-
-                        pixel_condition = currentImage == currentlabel
-                        pixel_replace_condition = currentlabel
-                        relabelimage = image_conditionals(
-                            relabelimage,
-                            pixel_condition,
-                            pixel_replace_condition,
-                        )
-
-                    else:
-                        pixel_condition = currentImage == currentlabel
-                        pixel_replace_condition = previouslabel
-                        relabelimage = image_conditionals(
-                            relabelimage,
-                            pixel_condition,
-                            pixel_replace_condition,
-                        )
-
-    return relabelimage
+    indices = np.asarray([prop.centroid for prop in waterproperties])
+    currentwaterproperties = measure.regionprops(currentImage)
+    currentindices = np.asarray([prop.centroid for prop in currentwaterproperties])
+    if len(indices) == 0 or len(currentindices) == 0:
+        return currentImage
+
+    tree = spatial.cKDTree(indices)
+    distances, previouspoints = tree.query(currentindices)
+    previouslabels = previousImage[
+        indices[previouspoints, 0].astype(int),
+        indices[previouspoints, 1].astype(int),
+    ]
+    centrelabels = currentImage[
+        currentindices[:, 0].astype(int), currentindices[:, 1].astype(int)
+    ]
+
+    # Every match replaces all pixels that currently hold the label found
+    # under the centroid, so later matches see the earlier replacements.
+    # Follow them on the label values and relabel the slice once at the end.
+    relabel = np.arange(int(currentImage.max()) + 1, dtype="uint16")
+    members = {
+        currentlabel: [currentlabel]
+        for currentlabel in np.unique(currentImage).tolist()
+    }
+    for i in range(len(currentindices)):
+        currentlabel = int(relabel[centrelabels[i]])
+        if currentlabel > 0 and distances[i] <= threshold:
+            previouslabel = int(previouslabels[i])
+            if previouslabel != currentlabel:
+                group = members.pop(currentlabel)
+                relabel[group] = previouslabel
+                members.setdefault(previouslabel, []).extend(group)
+
+    return relabel[currentImage]
 
 
 def CleanMask(star_labels, OverAllunet_mask):
@@ -4047,6 +4307,18 @@ def Bbox_region(image):
         return largest_bbox
 
 
+def upsample_prediction(SmallImage, grid, shape):
+    """Upsample a grid-subsampled StarDist output map in one pass.
+
+    All slices are interpolated together into a float32 array and only
+    the region covered by the label image of the given shape is returned.
+    """
+    output_shape = tuple(s * g for s, g in zip(SmallImage.shape, grid))
+    Image = resize(SmallImage.astype(np.float32, copy=False), output_shape)
+
+    return Image[tuple(slice(0, s) for s in shape)]
+
+
 def SuperSTARPrediction(
     image,
     model,
@@ -4071,35 +4343,22 @@ def SuperSTARPrediction(
     )
 
     grid = model.config.grid
-    Probability = resize(
-        SmallProbability,
-        output_shape=(
-            SmallProbability.shape[0] * grid[0],
-            SmallProbability.shape[1] * grid[1],
-        ),
-    )
-    Distance = MaxProjectDist(SmallDistance, axis=-1)
-    Distance = resize(
-        Distance,
-        output_shape=(
-            Distance.shape[0] * grid[0],
-            Distance.shape[1] * grid[1],
-        ),
-    )
-
-    pixel_condition = Probability < GLOBAL_THRESH
-    pixel_replace_condition = 0
-    Probability = image_conditionals(
-        Probability, pixel_condition, pixel_replace_condition
-    )
-
     if UseProbability:
 
-        MaxProjectDistance = Probability[: star_labels.shape[0], : star_labels.shape[1]]
+        MaxProjectDistance = upsample_prediction(
+            SmallProbability, grid, star_labels.shape
+        )
+        pixel_condition = MaxProjectDistance < GLOBAL_THRESH
+        pixel_replace_condition = 0
+        MaxProjectDistance = image_conditionals(
+            MaxProjectDistance, pixel_condition, pixel_replace_condition
+        )
 
     else:
 
-        MaxProjectDistance = Distance[: star_labels.shape[0], : star_labels.shape[1]]
+        MaxProjectDistance = upsample_prediction(
+            MaxProjectDist(SmallDistance, axis=-1), grid, star_labels.shape
+        )
 
     if OverAllunet_mask is None:
         OverAllunet_mask = unet_mask
@@ -4147,57 +4406,19 @@ def STARPrediction3D(
         nms_thresh=nms_thresh,
     )
 
-    if unet_mask is not None:
-        if UseProbability is False:
-
-            SmallDistance = MaxProjectDist(SmallDistance, axis=-1)
-            Distance = np.zeros(
-                [
-                    SmallDistance.shape[0] * grid[0],
-                    SmallDistance.shape[1] * grid[1],
-                    SmallDistance.shape[2] * grid[2],
-                ]
-            )
+    if UseProbability:
 
-        Probability = np.zeros(
-            [
-                SmallProbability.shape[0] * grid[0],
-                SmallProbability.shape[1] * grid[1],
-                SmallProbability.shape[2] * grid[2],
-            ]
+        MaxProjectDistance = upsample_prediction(
+            SmallProbability, grid, star_labels.shape
         )
 
-        # We only allow for the grid parameter to be 1 along the Z axis
-        for i in range(0, SmallProbability.shape[0]):
-            Probability[i, :] = resize(
-                SmallProbability[i, :],
-                output_shape=(Probability.shape[1], Probability.shape[2]),
-            )
-
-            if UseProbability is False:
-                Distance[i, :] = resize(
-                    SmallDistance[i, :],
-                    output_shape=(Distance.shape[1], Distance.shape[2]),
-                )
-
-        if UseProbability:
-
-            MaxProjectDistance = Probability[
-                : star_labels.shape[0],
-                : star_labels.shape[1],
-                : star_labels.shape[2],
-            ]
-
-        else:
+    else:
 
-            MaxProjectDistance = Distance[
-                : star_labels.shape[0],
-                : star_labels.shape[1],
-                : star_labels.shape[2],
-            ]
+        MaxProjectDistance = upsample_prediction(
+            MaxProjectDist(SmallDistance, axis=-1), grid, star_labels.shape
+        )
 
-        if unet_mask is None:
-            unet_mask = star_labels > 0
+    if unet_mask is not None:
 
         Watershed, markers = WatershedwithMask3D(
             MaxProjectDistance,
@@ -4220,58 +4441,55 @@ def STARPrediction3D(
         markers_raw = np.zeros_like(star_labels)
         markers_raw[tuple(coordinates_int.T)] = 1 + np.arange(len(Coordinates))
         markers = morphology.dilation(markers_raw.astype("uint16"), morphology.ball(2))
-        if UseProbability is False:
-
-            SmallDistance = MaxProjectDist(SmallDistance, axis=-1)
-            Distance = np.zeros(
-                [
-                    SmallDistance.shape[0] * grid[0],
-                    SmallDistance.shape[1] * grid[1],
-                    SmallDistance.shape[2] * grid[2],
-                ]
-            )
+    print("Returning StarPrediction 3D")
+    return Watershed, MaxProjectDistance, star_labels, markers
 
-        Probability = np.zeros(
-            [
-                SmallProbability.shape[0] * grid[0],
-                SmallProbability.shape[1] * grid[1],
-                SmallProbability.shape[2] * grid[2],
-            ]
-        )
 
-        # We only allow for the grid parameter to be 1 along the Z axis
-        for i in range(0, SmallProbability.shape[0]):
-            Probability[i, :] = resize(
-                SmallProbability[i, :],
-                output_shape=(Probability.shape[1], Probability.shape[2]),
-            )
+def _star_mask_include(Starbbox, BinaryCoordinates, backend):
 
-            if UseProbability is False:
-                Distance[i, :] = resize(
-                    SmallDistance[i, :],
-                    output_shape=(Distance.shape[1], Distance.shape[2]),
-                )
+    if backend == "vectorized":
+        return boxes_exclude_points(Starbbox, BinaryCoordinates)
+    if backend == "object":
+        return [
+            False
+            not in [UnetStarMask(box, unet).masking() for unet in BinaryCoordinates]
+            for box in Starbbox
+        ]
+    raise ValueError(f"Unknown seed pooling backend {backend}")
 
-        if UseProbability:
 
-            MaxProjectDistance = Probability[
-                : star_labels.shape[0],
-                : star_labels.shape[1],
-                : star_labels.shape[2],
-            ]
+def _pooled_seeds(Binarybbox, BinaryCoordinates, Coordinates, backend):
 
-        else:
+    if backend == "vectorized":
+        return pool_seeds(Binarybbox, BinaryCoordinates, Coordinates)
+    if backend == "object":
+        Coordinates = list(Coordinates)
+        pooled = []
+        for i in range(0, len(Binarybbox)):
+
+            box = Binarybbox[i]
+            include = [SeedPool(box, star).pooling() for star in Coordinates]
+
+            if False not in include:
+                Coordinates.append(BinaryCoordinates[i])
+                pooled.append(BinaryCoordinates[i])
+        return pooled
+    raise ValueError(f"Unknown seed pooling backend {backend}")
 
-            MaxProjectDistance = Distance[
-                : star_labels.shape[0],
-                : star_labels.shape[1],
-                : star_labels.shape[2],
-            ]
-    print("Returning StarPrediction 3D")
-    return Watershed, MaxProjectDistance, star_labels, markers
 
+def _promote_labels(mask, Label, labels):
 
-def SuperWatershedwithMask(Image, Label, mask, nms_thresh, seedpool, z_thresh=1):
+    # One lookup table pass over the volume for all promoted labels
+    if len(labels) == 0:
+        return mask
+    lut = np.zeros(int(Label.max()) + 1, dtype=bool)
+    lut[labels] = True
+    return image_conditionals(mask, lut[Label], 1)
+
+
+def SuperWatershedwithMask(
+    Image, Label, mask, nms_thresh, seedpool, z_thresh=1, backend="vectorized"
+):
 
     CopyImage = Image.copy()
     properties = measure.regionprops(Label)
@@ -4283,29 +4501,17 @@ def SuperWatershedwithMask(Image, Label, mask, nms_thresh, seedpool, z_thresh=1)
     Starbbox = [prop.bbox for prop in properties]
     Starlabel = [prop.label for prop in properties]
     if len(Starbbox) > 0:
-        for i in range(0, len(Starbbox)):
-
-            box = Starbbox[i]
-            starlabel = Starlabel[i]
-            include = [UnetStarMask(box, unet).masking() for unet in BinaryCoordinates]
-            if False not in include:
-                indices = zip(*np.where(Label == starlabel))
-                for index in indices:
-
-                    mask[index] = 1
+        include = _star_mask_include(Starbbox, BinaryCoordinates, backend)
+        mask = _promote_labels(mask, Label, np.asarray(Starlabel)[include])
 
     binaryproperties = measure.regionprops(label(mask))
     BinaryCoordinates = [prop.centroid for prop in binaryproperties]
     Binarybbox = [prop.bbox for prop in binaryproperties]
     if seedpool:
         if len(Binarybbox) > 0:
-            for i in range(0, len(Binarybbox)):
-
-                box = Binarybbox[i]
-                include = [SeedPool(box, star).pooling() for star in Coordinates]
-
-                if False not in include:
-                    Coordinates.append(BinaryCoordinates[i])
+            Coordinates.extend(
+                _pooled_seeds(Binarybbox, BinaryCoordinates, Coordinates, backend)
+            )
     Coordinates.append((0, 0))
     Coordinates = np.asarray(Coordinates)
 
@@ -4384,7 +4590,9 @@ def CellPoseWater(membrane_image, sized_smart_seeds, mask):
     return watershed_result
 
 
-def WatershedwithMask3D(Image, Label, mask, nms_thresh, seedpool=True, z_thresh=1):
+def WatershedwithMask3D(
+    Image, Label, mask, nms_thresh, seedpool=True, z_thresh=1, backend="vectorized"
+):
 
     print("Watershed with Mask 3D")
     CopyImage = Image.copy()
@@ -4398,15 +4606,8 @@ def WatershedwithMask3D(Image, Label, mask, nms_thresh, seedpool=True, z_thresh=
     Starbbox = [prop.bbox for prop in properties]
     Starlabel = [prop.label for prop in properties]
     if len(Starbbox) > 0:
-        for i in range(0, len(Starbbox)):
-
-            box = Starbbox[i]
-            starlabel = Starlabel[i]
-            include = [UnetStarMask(box, unet).masking() for unet in BinaryCoordinates]
-            if False not in include:
-                indices = zip(*np.where(Label == starlabel))
-                for index in indices:
-                    mask[index] = 1
+        include = _star_mask_include(Starbbox, BinaryCoordinates, backend)
+        mask = _promote_labels(mask, Label, np.asarray(Starlabel)[include])
     binaryproperties = measure.regionprops(label(mask))
     BinaryCoordinates = [prop.centroid for prop in binaryproperties]
     Binarybbox = [prop.bbox for prop in binaryproperties]
@@ -4414,13 +4615,9 @@ def WatershedwithMask3D(Image, Label, mask, nms_thresh, seedpool=True, z_thresh=
     if seedpool:
 
         if len(Binarybbox) > 0:
-            for i in range(0, len(Binarybbox)):
-
-                box = Binarybbox[i]
-                include = [SeedPool(box, star).pooling() for star in Coordinates]
-
-                if False not in include:
-                    Coordinates.append(BinaryCoordinates[i])
+            Coordinates.extend(
+                _pooled_seeds(Binarybbox, BinaryCoordinates, Coordinates, backend)
+            )
 
     Coordinates.append((0, 0, 0))
 